@@ -0,0 +1,164 @@
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+from instrumentation import instrumentation
+from serialization import output_json
+
+# Class of the endpoints missing in ADMISSION_ENDPOINTS
+DEFAULT_CLASS = 'default'
+# Class of the requests with a body over ADMISSION_BULK_BYTES
+BULK_CLASS = 'bulk'
+BUSY_MESSAGE = 'The server is busy, retry later'
+
+
+class Gate:
+    """Up to 'limit' requests of a class at a time, and up to 'queue' more waiting for one of them to finish"""
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def enter(self, timeout):
+        """Take a place, waiting up to 'timeout' seconds in the queue. Return the reason of a rejection, or None"""
+        with self.condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue:
+                    self.rejected_full += 1
+                    return 'queue_full'
+                self.waiting += 1
+                self.queued += 1
+                deadline = time.monotonic() + timeout
+                try:
+                    while self.active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected_timeout += 1
+                            return 'timeout'
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return None
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        return {'limit': self.limit, 'queue': self.queue, 'active': self.active, 'waiting': self.waiting,
+                'admitted': self.admitted, 'queued': self.queued,
+                'rejected': {'queue_full': self.rejected_full, 'timeout': self.rejected_timeout}}
+
+
+class AdmissionState:
+    def __init__(self, limits):
+        self.gates = {name: Gate(limit, queue) for name, (limit, queue) in limits.items()}
+
+
+class AdmissionControl:
+    """Limits of concurrent and waiting requests per class of endpoints, so a spike of expensive requests can't take
+    every connection and thread of the worker process. Requests over the limits get a 503 with Retry-After at once,
+    and waiting ones when no place frees up within ADMISSION_QUEUE_TIMEOUT_MS. Blueprints are added with register()"""
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_ENABLED', False)
+        app.config.setdefault('ADMISSION_LIMITS', {DEFAULT_CLASS: (16, 32)})
+        app.config.setdefault('ADMISSION_ENDPOINTS', {})
+        app.config.setdefault('ADMISSION_BULK_BYTES', 65536)
+        app.config.setdefault('ADMISSION_QUEUE_TIMEOUT_MS', 1000)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        if not app.config['ADMISSION_ENABLED']:
+            return
+        limits = dict(app.config['ADMISSION_LIMITS'])
+        unknown = set(app.config['ADMISSION_ENDPOINTS'].values()) - set(limits)
+        if unknown:
+            raise ValueError(f'Admission classes without limits: {", ".join(sorted(unknown))}')
+        app.extensions['admission'] = AdmissionState(limits)
+        instrumentation.add_metrics(app, self.metrics)
+
+    @property
+    def state(self):
+        return current_app.extensions['admission']
+
+    def register(self, blueprint, json_errors=False):
+        """Admit the requests of the blueprint's routes, rejecting them with a JSON message when 'json_errors'"""
+        def admit():
+            return self.admit(json_errors)
+        blueprint.before_request(admit)
+        blueprint.teardown_request(self.release)
+
+    @staticmethod
+    def request_class():
+        config = current_app.config
+        bulk = (request.content_length or 0) > config['ADMISSION_BULK_BYTES']
+        if bulk and BULK_CLASS in config['ADMISSION_LIMITS']:
+            return BULK_CLASS
+        endpoints = config['ADMISSION_ENDPOINTS']
+        return endpoints.get(f'{request.endpoint} {request.method}',
+                             endpoints.get(request.endpoint, DEFAULT_CLASS))
+
+    def admit(self, json_errors):
+        if not current_app.config['ADMISSION_ENABLED']:
+            return None
+        gate = self.state.gates.get(self.request_class())
+        if gate is None:
+            return None
+        if gate.enter(current_app.config['ADMISSION_QUEUE_TIMEOUT_MS'] / 1000) is not None:
+            return self.rejection(json_errors)
+        g.admission_gate = gate
+        return None
+
+    @staticmethod
+    def release(error=None):
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            gate.leave()
+
+    @staticmethod
+    def rejection(json_errors):
+        retry_after = current_app.config['ADMISSION_RETRY_AFTER']
+        if json_errors:
+            response = output_json({'message': BUSY_MESSAGE}, 503, {'Retry-After': str(retry_after)})
+            # As Api.make_response sets it for the resources
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        return ServiceUnavailable(BUSY_MESSAGE, retry_after=retry_after).get_response()
+
+    def stats(self):
+        return {name: gate.stats() for name, gate in self.state.gates.items()}
+
+    def metrics(self):
+        """Lines of the gauges and counters of every class in the Prometheus text format"""
+        classes = sorted(self.stats().items())
+        lines = ['# HELP http_admission_active Requests running per admission class.',
+                 '# TYPE http_admission_active gauge']
+        lines += [f'http_admission_active{{class="{name}"}} {stats["active"]}' for name, stats in classes]
+        lines += ['# HELP http_admission_queue_depth Requests waiting for a place per admission class.',
+                  '# TYPE http_admission_queue_depth gauge']
+        lines += [f'http_admission_queue_depth{{class="{name}"}} {stats["waiting"]}' for name, stats in classes]
+        lines += ['# HELP http_admission_admitted_total Requests admitted per admission class.',
+                  '# TYPE http_admission_admitted_total counter']
+        lines += [f'http_admission_admitted_total{{class="{name}"}} {stats["admitted"]}' for name, stats in classes]
+        lines += ['# HELP http_admission_queued_total Requests that waited for a place per admission class.',
+                  '# TYPE http_admission_queued_total counter']
+        lines += [f'http_admission_queued_total{{class="{name}"}} {stats["queued"]}' for name, stats in classes]
+        lines += ['# HELP http_admission_rejected_total Requests rejected with a 503 per admission class.',
+                  '# TYPE http_admission_rejected_total counter']
+        lines += [f'http_admission_rejected_total{{class="{name}",reason="{reason}"}} {count}'
+                  for name, stats in classes for reason, count in stats['rejected'].items()]
+        return lines
+
+
+admission = AdmissionControl()
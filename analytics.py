@@ -0,0 +1,179 @@
+import io
+import itertools
+
+import numpy as np
+from sqlalchemy import func, select
+
+from models import db, GroupModel, StudentModel, CourseModel, attending
+
+# Course pairs are counted in a dense matrix up to this many cells, as sorted pair keys beyond it
+DENSE_MATRIX_CELLS = 4000000
+# Pair keys collected before they are added to the counts
+PENDING_KEYS = 1000000
+# Group key of the students without a group
+NO_GROUP = 0
+
+
+def merge_counts(parts):
+    """Sum counts of equal keys over (keys, counts) array pairs. Return the distinct keys in order and their counts"""
+    if not parts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    keys, inverse = np.unique(np.concatenate([keys for keys, _ in parts]), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate([counts for _, counts in parts]),
+                         minlength=len(keys))
+    return keys, counts.astype(np.int64)
+
+
+class PairCounter:
+    """Students of every pair of course positions (i, j), i < j, keyed by i * courses + j"""
+
+    def __init__(self, courses):
+        self.courses = courses
+        self.dense = courses * courses <= DENSE_MATRIX_CELLS
+        self.matrix = np.zeros(courses * courses, np.int64) if self.dense else None
+        self.parts = []
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, keys):
+        self.pending.append(keys)
+        self.pending_size += len(keys)
+        if self.pending_size >= PENDING_KEYS:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        keys = np.concatenate(self.pending)
+        self.pending, self.pending_size = [], 0
+        if self.dense:
+            self.matrix += np.bincount(keys, minlength=len(self.matrix))
+            return
+        self.parts.append(np.unique(keys, return_counts=True))
+        # Merged now and then, so memory stays bounded by the distinct pairs
+        if len(self.parts) >= 16:
+            self.parts = [merge_counts(self.parts)]
+
+    def result(self):
+        self.flush()
+        if self.dense:
+            keys = np.flatnonzero(self.matrix)
+            return keys, self.matrix[keys]
+        return merge_counts(self.parts)
+
+
+def count_chunk(student_ids, course_positions, group_keys, pair_counter, distribution_parts, max_courses):
+    """Count course pairs and courses per student of rows sorted by student and course, whole students only"""
+    # Rows 'offset' apart belong to one student for every pair of its courses
+    for offset in itertools.count(1):
+        same = student_ids[offset:] == student_ids[:-offset]
+        if not same.any():
+            break
+        pair_counter.add(course_positions[:-offset][same] * pair_counter.courses + course_positions[offset:][same])
+    starts = np.flatnonzero(np.r_[True, student_ids[1:] != student_ids[:-1]])
+    courses_taken = np.diff(np.r_[starts, len(student_ids)])
+    distribution_parts.append(np.unique(group_keys[starts] * max_courses + courses_taken, return_counts=True))
+
+
+def read_int_rows(connection, statement, columns):
+    """Rows of a statement selecting 'columns' non-null integer columns as an array, read without the row
+    processing of SQLAlchemy. PostgreSQL sends them with a binary COPY"""
+    sql = str(statement.compile(connection, compile_kwargs={'literal_binds': True}))
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.name == 'postgresql':
+            buffer = io.BytesIO()
+            cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT binary)', buffer)
+            data = buffer.getbuffer()
+            # Signature, flags and header extension, then rows of a field count and a length and int4 per field
+            start = 19 + int.from_bytes(data[15:19], 'big')
+            row_type = np.dtype([('fields', '>i2')] + [(f'{name}{column}', '>i4') for column in range(columns)
+                                                        for name in ('length', 'value')])
+            rows = np.frombuffer(data[start:len(data) - 2], row_type)
+            return np.stack([rows[f'value{column}'] for column in range(columns)], axis=1).astype(np.int64)
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        return np.fromiter(itertools.chain.from_iterable(rows), np.int64, len(rows) * columns).reshape(-1, columns)
+    finally:
+        cursor.close()
+
+
+def iter_chunks(batch_size):
+    """Arrays of student IDs, course IDs and group keys of all attendings, sorted by student and course,
+    of 'batch_size' student IDs at a time"""
+    connection = db.session.connection()
+    first_id, last_id = connection.execute(select(func.min(attending.c.student_id),
+                                                  func.max(attending.c.student_id))).one()
+    if first_id is None:
+        return
+    for start_id in range(first_id, last_id + 1, batch_size):
+        end_id = start_id + batch_size - 1
+        # Both are read in primary key order and joined here, a join in the database sorts or hashes the rows
+        attendings = read_int_rows(connection, select(attending.c.student_id, attending.c.course_id)
+                                   .where(attending.c.student_id.between(start_id, end_id))
+                                   .order_by(attending.c.student_id, attending.c.course_id), 2)
+        if not len(attendings):
+            continue
+        students = read_int_rows(connection, select(StudentModel.id, func.coalesce(StudentModel.group_id, NO_GROUP))
+                                 .where(StudentModel.id.between(start_id, end_id))
+                                 .order_by(StudentModel.id), 2)
+        group_keys = students[np.searchsorted(students[:, 0], attendings[:, 0]), 1]
+        yield attendings[:, 0], attendings[:, 1], group_keys
+
+
+class CoEnrollment:
+    """Students of every course and of every pair of courses, and the amount of courses per student of every group"""
+
+    def __init__(self, courses, pair_course_ids, pair_students, groups):
+        self.courses = courses
+        # Pairs with most students first
+        order = np.lexsort((pair_course_ids[:, 1], pair_course_ids[:, 0], -pair_students))
+        self.pair_course_ids = pair_course_ids[order]
+        self.pair_students = pair_students[order]
+        self.groups = groups
+
+    def pairs(self, min_students, limit):
+        """Up to 'limit' course pairs taken together by at least 'min_students' students"""
+        count = min(limit, int(np.searchsorted(-self.pair_students, -min_students, side='right')))
+        return [{'course_ids': course_ids, 'students': students}
+                for course_ids, students in zip(self.pair_course_ids[:count].tolist(),
+                                                self.pair_students[:count].tolist())]
+
+
+def co_enrollment(batch_size):
+    """CoEnrollment of the whole database, counted in one pass over the attendings"""
+    courses = db.session.execute(select(CourseModel.id, CourseModel.course_name).order_by(CourseModel.id)).all()
+    course_ids = np.array([course_id for course_id, _ in courses], np.int64)
+    group_names = dict(db.session.execute(select(GroupModel.id, GroupModel.name)).all())
+    # Students per group, including the ones without courses
+    group_students = dict(db.session.execute(select(func.coalesce(StudentModel.group_id, NO_GROUP), func.count())
+                                             .group_by(StudentModel.group_id)).all())
+
+    max_courses = len(courses) + 1
+    pair_counter = PairCounter(len(courses))
+    distribution_parts = []
+    enrolled = np.zeros(len(courses), np.int64)
+    for student_ids, chunk_course_ids, group_keys in iter_chunks(batch_size):
+        course_positions = np.searchsorted(course_ids, chunk_course_ids)
+        enrolled += np.bincount(course_positions, minlength=len(courses))
+        count_chunk(student_ids, course_positions, group_keys, pair_counter, distribution_parts, max_courses)
+    pair_keys, pair_students = pair_counter.result()
+    pair_course_ids = course_ids[np.stack(np.divmod(pair_keys, max(1, len(courses))), axis=1)]
+
+    group_ids = sorted(set(group_names) | set(group_students))
+    keys, counts = merge_counts(distribution_parts)
+    group_keys, courses_taken = np.divmod(keys, max_courses)
+    distributions = np.zeros((len(group_ids), int(courses_taken.max(initial=0)) + 1), np.int64)
+    distributions[np.searchsorted(group_ids, group_keys), courses_taken] = counts
+    distributions[:, 0] = [group_students.get(group_id, 0) for group_id in group_ids]
+    distributions[:, 0] -= distributions[:, 1:].sum(axis=1)
+
+    return CoEnrollment(
+        [{'id': course_id, 'course_name': name, 'students': students}
+         for (course_id, name), students in zip(courses, enrolled.tolist())],
+        pair_course_ids, pair_students,
+        [{'group_id': None if group_id == NO_GROUP else group_id, 'name': group_names.get(group_id),
+          'students': sum(distribution),
+          'enrollments': sum(amount * students for amount, students in enumerate(distribution)),
+          'courses_per_student': distribution}
+         for group_id, distribution in zip(group_ids, distributions.tolist())])
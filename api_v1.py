@@ -1,16 +1,31 @@
-from typing import List
-from pydantic import BaseModel, ValidationError
-from flask import Blueprint, request
-from flask_restful import Resource, abort, Api, fields, marshal_with
-from sqlalchemy import func, delete, exists, and_
+from typing import List, Optional
+from pydantic import BaseModel, PositiveInt, ValidationError
+from flask import Blueprint, current_app, request
+from flask_restful import Resource, abort, Api, fields
+from sqlalchemy import delete, select
 
+from admission import admission
+from batch import abort_missing, delete_attendings, delete_students, missing_ids, move_students
+from cache import cache
+from coalescing import enrollment_writer
+from conditional import conditional
+from dialects import insert_ignore_rows, insert_returning_ids
+from export import EXPORT_TABLES, MEDIA_TYPES, export_response
+from grouping import auto_assign
 from models import db, GroupModel, StudentModel, attending, CourseModel
+from pagination import page_args, keyset_query, split_page
+from replica import read_only
+from roster import roster
+from search import find_students
+from serialization import field_columns, output_json, row_to_dict, rows_to_dicts
 
 MAX_GROUP_SIZE = 30
 
 
 api_bp = Blueprint('api', __name__)
 api = Api(api_bp, default_mediatype='application/json')
+api.representation('application/json')(output_json)
+admission.register(api_bp, json_errors=True)
 
 
 class CourseValidator(BaseModel):
@@ -25,6 +40,20 @@ class CourseListValidator(BaseModel):
 class NewStudentValidator(BaseModel):
     first_name: str
     last_name: str
+    group_id: Optional[int] = None
+
+
+class NewStudentListValidator(BaseModel):
+    students: List[NewStudentValidator]
+
+
+class StudentIdsValidator(BaseModel):
+    ids: List[int]
+
+
+class AutoAssignValidator(BaseModel):
+    max_size: Optional[PositiveInt] = None
+    dry_run: bool = False
 
 
 group_fields = {
@@ -39,9 +68,34 @@ student_fields = {
     'last_name': fields.String,
 }
 
+# Rows of these select the fields above as marshal() would output them
+group_columns = field_columns(group_fields, group_name=GroupModel.name, students_amount=GroupModel.students_count)
+student_columns = field_columns(student_fields, id=StudentModel.id, group_id=StudentModel.group_id,
+                                first_name=StudentModel.first_name, last_name=StudentModel.last_name)
+
+
+def groups_up_to(max_size):
+    """Groups that has below or equal to 'max_size' amount of students, found by the students_count index"""
+    return rows_to_dicts(db.session.execute(select(*group_columns)
+                                            .where(GroupModel.students_count > 0,
+                                                   GroupModel.students_count <= max_size)
+                                            .order_by(GroupModel.id)).all())
+
+
+def missing_courses(course_ids):
+    """Sorted IDs of 'course_ids' without a course. Courses are few and change rarely, so their IDs are kept
+    in the aggregate cache instead of being queried on every write. IDs it does not know are looked up,
+    they may belong to courses added by a process the versions backend does not see"""
+    if not current_app.config['CACHE_ENABLED']:
+        return missing_ids(db.session, CourseModel.id, course_ids)
+    existing = cache.get_or_compute('api.course_ids', None, ('courses',),
+                                    lambda: frozenset(db.session.execute(select(CourseModel.id)).scalars()))
+    return missing_ids(db.session, CourseModel.id, set(course_ids) - existing)
+
 
 class Groups(Resource):
-    @marshal_with(group_fields)
+    @read_only
+    @conditional('groups', 'students')
     def get(self):
         """Output all groups that has below or equal to 'max_size' amount of students"""
         max_size = request.args.get('max_size')
@@ -49,63 +103,49 @@ class Groups(Resource):
             max_size = int(max_size)
         except (ValueError, TypeError):
             max_size = MAX_GROUP_SIZE
-        group_list = (db.session
-                      .query(GroupModel.name.label('group_name'),
-                             func.count(GroupModel.students).label('students_amount'))
-                      .join(StudentModel)
-                      .group_by(GroupModel.id)
-                      .having(func.count(GroupModel.students) <= max_size)
-                      )
-        return [group for group in group_list], 200
-
-
-def attending_exists(student_id, course_id):
-    """ Check existence of some record in 'attending' table"""
-    row_exists = (db.session.query(exists().where(and_(attending.c.student_id == student_id,
-                                                       attending.c.course_id == course_id))).scalar())
-    return True if row_exists else False
+        group_list = cache.get_or_compute('api.groups', max_size, ('groups', 'students'),
+                                          lambda: groups_up_to(max_size))
+        return group_list, 200
 
 
 class Courses(Resource):
-    @marshal_with(student_fields)
+    @read_only
+    @conditional('courses', 'attending', 'students')
     def get(self, course_name):
-        """Output all students attended to current course"""
-        students_list = (db.session
-                         .query(StudentModel)
-                         .join(attending)
-                         .join(CourseModel)
-                         .where(CourseModel.course_name == course_name)
-                         .all()
-                         )
-        if students_list:
-            return students_list, 200
-        else:
+        """Output a page of students attended to current course, ordered by ID"""
+        course_id = db.session.query(CourseModel.id).filter(CourseModel.course_name == course_name).scalar()
+        if course_id is None:
             abort(404, message=f'Course <{course_name}> does not exist')
+        after_id, limit = page_args()
+        students_query = select(*student_columns).join(attending).where(attending.c.course_id == course_id)
+        rows = db.session.execute(keyset_query(students_query, attending.c.student_id, after_id, limit)).all()
+        students_list, next_id = split_page(rows, limit)
+        return {'students': rows_to_dicts(students_list), 'next': next_id}, 200
 
     def put(self):
-        """Add student to course from list. 'new_courses' receive json list"""
+        """Add students to courses from list in statements of up to ENROLLMENTS_BATCH_SIZE pairs.
+        Pairs already in the database are skipped"""
         try:
             new_attendings = CourseListValidator.parse_obj(request.get_json()).attending_list
         except ValidationError as err:
             return err.json()
 
-        if new_attendings:
-            existing_students = [student_id for student_id, in db.session.query(StudentModel.id).all()]
-            existing_courses = [course_id for course_id, in db.session.query(CourseModel.id).all()]
+        pairs = list(dict.fromkeys((row.student_id, row.course_id) for row in new_attendings))
+        inserted = 0
+        if pairs:
+            abort_missing(students=missing_ids(db.session, StudentModel.id, {student_id for student_id, _ in pairs}),
+                          courses=missing_courses({course_id for _, course_id in pairs}))
 
-            for row in new_attendings:
-                student_id = row.student_id
-                course_id = row.course_id
-                if student_id not in existing_students:
-                    abort(404, message=f'Student with ID <{student_id}> does not exist')
-                if course_id not in existing_courses:
-                    abort(404, message=f'Course with ID <{course_id}> does not exist')
-                if not attending_exists(student_id, course_id):
-                    new_attending = attending.insert().values(student_id=student_id, course_id=course_id)
-                    db.session.execute(new_attending)
-                    db.session.commit()
+            new_rows = [{'student_id': student_id, 'course_id': course_id} for student_id, course_id in pairs]
+            inserted = insert_ignore_rows(db.session, db.engine, attending, new_rows,
+                                          current_app.config['ENROLLMENTS_BATCH_SIZE'])
+            cache.mark_changed('attending')
+            roster.enrolled(pairs)
+            db.session.commit()
 
-        return {'message': 'Success: added all records that were not yet in the database'}, 201
+        return {'message': 'Success: added all records that were not yet in the database',
+                'inserted': inserted,
+                'skipped': len(new_attendings) - inserted}, 201
 
     def delete(self):
         """Delete student from specified course"""
@@ -113,41 +153,220 @@ class Courses(Resource):
             attending_data = CourseValidator.parse_obj(request.get_json())
         except ValidationError as err:
             return err.json()
-        student_id = attending_data.student_id
-        course_id = attending_data.course_id
-        del_attending = (attending.delete()
-                         .where(attending.c.student_id == student_id, attending.c.course_id == course_id))
-        db.session.execute(del_attending)
-        db.session.commit()
+        enrollment_writer.remove(attending_data.student_id, attending_data.course_id)
         return '', 204
 
 
 class Students(Resource):
+    def get(self, student_id=None):
+        """Output student by ID or a page of all students, ordered by ID"""
+        if student_id is not None:
+            student = db.session.execute(select(*student_columns).where(StudentModel.id == student_id)).first()
+            if student is None:
+                abort(404, message=f'Student with ID <{student_id}> does not exist')
+            return row_to_dict(student), 200
+        after_id, limit = page_args()
+        rows = db.session.execute(keyset_query(select(*student_columns), StudentModel.id, after_id, limit)).all()
+        students_list, next_id = split_page(rows, limit)
+        return {'students': rows_to_dicts(students_list), 'next': next_id}, 200
+
     def post(self):
-        """Add new student"""
+        """Add new student, or a list of students given as a json list or in 'students'"""
+        payload = request.get_json()
+        batch = isinstance(payload, list) or (isinstance(payload, dict) and 'students' in payload)
         try:
-            new_student_data = NewStudentValidator.parse_obj(request.get_json())
+            if batch:
+                new_students = NewStudentListValidator.parse_obj(
+                    {'students': payload} if isinstance(payload, list) else payload).students
+            else:
+                new_students = [NewStudentValidator.parse_obj(payload)]
         except ValidationError as err:
             return err.json()
-        first_name = new_student_data.first_name
-        last_name = new_student_data.last_name
-        new_student = StudentModel(group_id=None, first_name=first_name, last_name=last_name)
-        db.session.add(new_student)
+
+        group_ids = {student.group_id for student in new_students if student.group_id is not None}
+        abort_missing(groups=missing_ids(db.session, GroupModel.id, group_ids))
+
+        new_rows = [student.dict() for student in new_students]
+        new_ids = insert_returning_ids(db.session, db.engine, StudentModel.__table__, new_rows,
+                                       current_app.config['STUDENTS_BATCH_SIZE'])
+        cache.mark_changed('students')
+        roster.students_added(zip(new_ids, (row['group_id'] for row in new_rows)))
         db.session.commit()
 
-        return {'message': 'Student added successfully'}, 201
+        if batch:
+            return {'message': 'Students added successfully', 'ids': new_ids}, 201
+        return {'message': 'Student added successfully', 'id': new_ids[0]}, 201
 
     def delete(self, student_id):
-        """Delete student by ID"""
-        del_attending = attending.delete().where(attending.c.student_id == student_id)
-        db.session.execute(del_attending)
+        """Delete student by ID. Attendings are removed by the database cascade"""
         del_student = delete(StudentModel).where(StudentModel.id == student_id)
         db.session.execute(del_student)
+        cache.mark_changed('students', 'attending')
+        roster.students_deleted([student_id])
         db.session.commit()
         return '', 204
 
 
+class StudentSearch(Resource):
+    @read_only
+    def get(self):
+        """Output students with a first or last name starting with or containing 'q', prefix matches first"""
+        text = request.args.get('q', default='').strip()
+        if not text:
+            abort(400, message='Parameter <q> is required')
+        limit = request.args.get('limit', type=int, default=current_app.config['SEARCH_LIMIT'])
+        limit = max(1, min(limit, current_app.config['MAX_PAGE_SIZE']))
+        return {'students': find_students(text, limit, student_columns)}, 200
+
+
+def named_ids(parameter, ids, kind):
+    """IDs of the names given in the query string parameter, a 404 for an unknown name"""
+    result = []
+    for name in request.args.getlist(parameter):
+        if name not in ids:
+            abort(404, message=f'{kind} <{name}> does not exist')
+        result.append(ids[name])
+    return result
+
+
+class StudentQuery(Resource):
+    def get(self):
+        """Output a page of students ordered by ID, taking every 'course', at least one 'any_course' and no
+        'not_course', in one of the 'group' groups if given and in no 'not_group' group. Group 'none' stands
+        for the students without a group. The students are selected with the bitmaps of the roster index"""
+        # Committed changes are applied to the index in place, under the same lock
+        with roster.state.lock:
+            index = roster.index()
+            selected = index.select(all_courses=named_ids('course', index.course_ids, 'Course'),
+                                    any_courses=named_ids('any_course', index.course_ids, 'Course'),
+                                    no_courses=named_ids('not_course', index.course_ids, 'Course'),
+                                    groups=named_ids('group', index.group_ids, 'Group'),
+                                    no_groups=named_ids('not_group', index.group_ids, 'Group'))
+        after_id, limit = page_args()
+        student_ids, count = index.page(selected, after_id, limit + 1)
+        rows = db.session.execute(select(*student_columns)
+                                  .where(StudentModel.id.in_(student_ids))
+                                  .order_by(StudentModel.id)).all()
+        students_list, next_id = split_page(rows, limit)
+        return {'students': rows_to_dicts(students_list), 'count': count, 'next': next_id}, 200
+
+
+class StudentsBatchDelete(Resource):
+    def post(self):
+        """Delete students from list of IDs in one statement. Output the outcome of every ID"""
+        try:
+            student_ids = StudentIdsValidator.parse_obj(request.get_json()).ids
+        except ValidationError as err:
+            return err.json()
+        results = delete_students(db.session, db.engine, student_ids)
+        cache.mark_changed('students', 'attending')
+        roster.students_deleted(student_ids)
+        db.session.commit()
+        return {'results': results}, 200
+
+
+class CoursesBatchDelete(Resource):
+    def post(self):
+        """Delete students from courses from list in one statement. Output the outcome of every pair"""
+        try:
+            attendings = CourseListValidator.parse_obj(request.get_json()).attending_list
+        except ValidationError as err:
+            return err.json()
+        pairs = [(row.student_id, row.course_id) for row in attendings]
+        results = delete_attendings(db.session, db.engine, pairs)
+        cache.mark_changed('attending')
+        roster.unenrolled(pairs)
+        db.session.commit()
+        return {'results': results}, 200
+
+
+class GroupMembers(Resource):
+    def post(self, group_id):
+        """Move students from list of IDs to the group, all of them or none if the group would be too big"""
+        try:
+            student_ids = StudentIdsValidator.parse_obj(request.get_json()).ids
+        except ValidationError as err:
+            return err.json()
+        results = move_students(db.session, group_id, student_ids, MAX_GROUP_SIZE)
+        cache.mark_changed('students', 'groups')
+        roster.students_moved([result['id'] for result in results if result['outcome'] == 'moved'], group_id)
+        db.session.commit()
+        return {'results': results}, 200
+
+
+def assignment_result(plan, dry_run):
+    return {'dry_run': dry_run,
+            'assigned': sum(entry['assigned'] for entry in plan),
+            'new_groups': sum(1 for entry in plan if entry['new']),
+            'groups': plan}
+
+
+class GroupsAutoAssign(Resource):
+    def post(self):
+        """Assign all students without a group to the least filled groups, adding groups when they are full.
+        Output the plan, applied unless 'dry_run'"""
+        try:
+            options = AutoAssignValidator.parse_obj(request.get_json() or {})
+        except ValidationError as err:
+            return err.json()
+        max_size = options.max_size or MAX_GROUP_SIZE
+        if max_size > MAX_GROUP_SIZE:
+            abort(400, message=f'Parameter <max_size> can not exceed {MAX_GROUP_SIZE}')
+        plan = auto_assign(db.session, db.engine, max_size, options.dry_run,
+                           current_app.config['STUDENTS_BATCH_SIZE'])
+        if not options.dry_run:
+            cache.mark_changed('students', 'groups')
+            db.session.commit()
+        return assignment_result(plan, options.dry_run), 200
+
+
+class Export(Resource):
+    def get(self, table_name):
+        """Stream all rows of the table as NDJSON or CSV"""
+        export_format = request.args.get('format', default='ndjson')
+        if table_name not in EXPORT_TABLES:
+            abort(404, message=f'Table <{table_name}> can not be exported')
+        if export_format not in MEDIA_TYPES:
+            abort(400, message=f'Format <{export_format}> is not supported, use one of: {", ".join(MEDIA_TYPES)}')
+        return export_response(table_name, export_format)
+
+
+class CoEnrollment(Resource):
+    @read_only
+    @conditional('attending', 'students', 'groups', 'courses')
+    def get(self):
+        """Output students of every course, the course pairs taken together by most students
+        and the amount of courses taken per student of every group"""
+        # NumPy is imported by the first request only, the other workers start without it
+        from analytics import co_enrollment
+        min_students = max(1, request.args.get('min_students', type=int, default=1))
+        limit = request.args.get('limit', type=int, default=current_app.config['PAGE_SIZE'])
+        limit = max(1, min(limit, current_app.config['MAX_PAGE_SIZE']))
+        result = cache.get_or_compute('api.co_enrollment', None, ('attending', 'students', 'groups', 'courses'),
+                                      lambda: co_enrollment(current_app.config['ANALYTICS_BATCH_SIZE']))
+        return {'students': sum(group['students'] for group in result.groups),
+                'enrollments': sum(course['students'] for course in result.courses),
+                'courses': result.courses,
+                'pairs': result.pairs(min_students, limit),
+                'groups': result.groups}, 200
+
+
+class CacheStats(Resource):
+    def get(self):
+        """Output hit and miss counters of the aggregate cache"""
+        return cache.stats(), 200
+
+
 api.add_resource(Students, '/students/', '/students/<int:student_id>')
+api.add_resource(StudentSearch, '/students/search')
+api.add_resource(StudentQuery, '/students/query')
+api.add_resource(StudentsBatchDelete, '/students/batch-delete')
 api.add_resource(Groups, '/groups/')
+api.add_resource(GroupMembers, '/groups/<int:group_id>/members')
+api.add_resource(GroupsAutoAssign, '/groups/auto-assign')
 api.add_resource(Courses, '/courses/', '/courses/<string:course_name>')
+api.add_resource(CoursesBatchDelete, '/courses/batch-delete')
+api.add_resource(Export, '/export/<string:table_name>')
+api.add_resource(CoEnrollment, '/analytics/co-enrollment')
+api.add_resource(CacheStats, '/cache/')
 
@@ -0,0 +1,448 @@
+"""ASGI entry point serving the /api/v1 routes with the asyncio engine of SQLAlchemy
+
+Run it with an ASGI server, for example:
+    uvicorn asgi:app --workers 1
+
+Handlers return the same responses as the resources of api_v1 and use the same validators.
+The aggregate cache lives in the WSGI processes, so /api/v1/cache/ and /api/v1/analytics/co-enrollment,
+which depends on it, are not served here, nor /api/v1/students/query with its in-memory roster index;
+with CACHE_BACKEND = 'database' writes made here still invalidate their cached results.
+Admission control of the WSGI app is not applied here either.
+"""
+import json
+import logging
+import time
+
+from flask import Config
+from flask_restful import abort
+from pydantic import ValidationError
+from sqlalchemy import delete, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, RequestRedirect, Rule
+from werkzeug.urls import url_decode
+
+from api_v1 import (MAX_GROUP_SIZE, AutoAssignValidator, CourseListValidator, CourseValidator,
+                    NewStudentListValidator, NewStudentValidator, StudentIdsValidator, assignment_result,
+                    group_columns, student_columns)
+from batch import abort_missing, delete_attendings, delete_students, missing_ids, move_students
+from config import BaseConfig
+from dialects import (insert_ignore_rows, insert_or_increment, insert_returning_ids, listen_sqlite_pragmas,
+                      sqlite_pragmas)
+from export import EXPORT_TABLES, FORMATTERS, MEDIA_TYPES
+from grouping import auto_assign
+from models import GroupModel, StudentModel, CourseModel, attending, table_versions
+from pagination import keyset_query, page_args, split_page
+from search import search_students
+from serialization import dumps, row_to_dict, rows_to_dicts
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+logger = logging.getLogger(__name__)
+
+
+def create_engine_from(config, uri):
+    """Async engine with the pool settings and the statement timeout or the SQLite pragmas of the config"""
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    options = {'pool_pre_ping': config.get('DATABASE_POOL_PRE_PING', False),
+               'pool_recycle': config.get('DATABASE_POOL_RECYCLE', -1)}
+    if backend != 'sqlite':
+        options.update(pool_size=config.get('DATABASE_POOL_SIZE', 5),
+                       max_overflow=config.get('DATABASE_MAX_OVERFLOW', 10))
+    timeout = config.get('DATABASE_STATEMENT_TIMEOUT_MS')
+    if timeout and backend == 'postgresql':
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(timeout)}}
+    engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[backend]), **options)
+    if backend == 'sqlite':
+        listen_sqlite_pragmas(engine.sync_engine, sqlite_pragmas(config))
+    return engine
+
+
+def read_only(handler):
+    """Mark the handler to run against the read replica, as replica.read_only does for the WSGI app"""
+    handler.read_only = True
+    return handler
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = url_decode(scope['query_string'])
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    def get_json(self):
+        """Parsed body, or None unless it is sent as JSON, like flask.Request.get_json"""
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip()
+        if not (mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError as err:
+            abort(400, message=f'Failed to decode JSON object: {err}')
+
+
+class Response:
+    def __init__(self, body, status=200, headers=()):
+        self.status = status
+        self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        self.body = body
+
+    async def send(self, send):
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': self.headers + [(b'content-length', str(len(self.body)).encode())]})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def json_response(data, status, config):
+    # Flask-RESTful sends an empty body with 204
+    body = b'' if status == 204 else dumps(data, config, config.get('DEBUG'))
+    return Response(body, status, [('Content-Type', 'application/json')])
+
+
+class StreamingResponse:
+    def __init__(self, chunks, media_type, headers=()):
+        self.chunks = chunks
+        self.headers = [(b'content-type', media_type.encode())] + [(name.encode(), value.encode())
+                                                                  for name, value in headers]
+
+    async def send(self, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': self.headers})
+        async for chunk in self.chunks:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+class Groups:
+    @read_only
+    async def get(self, api, request, engine):
+        """Output all groups that has below or equal to 'max_size' amount of students"""
+        max_size = request.args.get('max_size')
+        try:
+            max_size = int(max_size)
+        except (ValueError, TypeError):
+            max_size = MAX_GROUP_SIZE
+        statement = (select(*group_columns)
+                     .where(GroupModel.students_count > 0, GroupModel.students_count <= max_size)
+                     .order_by(GroupModel.id))
+        async with engine.connect() as conn:
+            group_list = (await conn.execute(statement)).all()
+        return rows_to_dicts(group_list), 200
+
+
+class Courses:
+    @read_only
+    async def get(self, api, request, engine, course_name):
+        """Output a page of students attended to current course, ordered by ID"""
+        after_id, limit = page_args(request.args, api.config)
+        async with engine.connect() as conn:
+            course_id = (await conn.execute(select(CourseModel.id)
+                                            .where(CourseModel.course_name == course_name))).scalar()
+            if course_id is None:
+                abort(404, message=f'Course <{course_name}> does not exist')
+            students_query = select(*student_columns).join(attending).where(attending.c.course_id == course_id)
+            rows = (await conn.execute(keyset_query(students_query, attending.c.student_id, after_id, limit))).all()
+        students_list, next_id = split_page(rows, limit)
+        return {'students': rows_to_dicts(students_list), 'next': next_id}, 200
+
+    async def put(self, api, request, engine):
+        """Add students to courses from list in one statement. Pairs already in the database are skipped"""
+        try:
+            new_attendings = CourseListValidator.parse_obj(request.get_json()).attending_list
+        except ValidationError as err:
+            return err.json(), 200
+
+        pairs = list(dict.fromkeys((row.student_id, row.course_id) for row in new_attendings))
+        inserted = 0
+        if pairs:
+            async with engine.begin() as conn:
+                abort_missing(
+                    students=await conn.run_sync(missing_ids, StudentModel.id, {student_id for student_id, _ in pairs}),
+                    courses=await conn.run_sync(missing_ids, CourseModel.id, {course_id for _, course_id in pairs}))
+
+                new_rows = [{'student_id': student_id, 'course_id': course_id} for student_id, course_id in pairs]
+                inserted = await conn.run_sync(lambda sync_conn: insert_ignore_rows(
+                    sync_conn, sync_conn, attending, new_rows, api.config['ENROLLMENTS_BATCH_SIZE']))
+                await api.mark_changed(conn, 'attending')
+
+        return {'message': 'Success: added all records that were not yet in the database',
+                'inserted': inserted,
+                'skipped': len(new_attendings) - inserted}, 201
+
+    async def delete(self, api, request, engine):
+        """Delete student from specified course"""
+        try:
+            attending_data = CourseValidator.parse_obj(request.get_json())
+        except ValidationError as err:
+            return err.json(), 200
+        async with engine.begin() as conn:
+            await conn.execute(attending.delete().where(attending.c.student_id == attending_data.student_id,
+                                                        attending.c.course_id == attending_data.course_id))
+            await api.mark_changed(conn, 'attending')
+        return '', 204
+
+
+class Students:
+    async def get(self, api, request, engine, student_id=None):
+        """Output student by ID or a page of all students, ordered by ID"""
+        if student_id is not None:
+            async with engine.connect() as conn:
+                student = (await conn.execute(select(*student_columns).where(StudentModel.id == student_id))).first()
+            if student is None:
+                abort(404, message=f'Student with ID <{student_id}> does not exist')
+            return row_to_dict(student), 200
+        after_id, limit = page_args(request.args, api.config)
+        async with engine.connect() as conn:
+            rows = (await conn.execute(keyset_query(select(*student_columns), StudentModel.id, after_id, limit))).all()
+        students_list, next_id = split_page(rows, limit)
+        return {'students': rows_to_dicts(students_list), 'next': next_id}, 200
+
+    async def post(self, api, request, engine):
+        """Add new student, or a list of students given as a json list or in 'students'"""
+        payload = request.get_json()
+        batch = isinstance(payload, list) or (isinstance(payload, dict) and 'students' in payload)
+        try:
+            if batch:
+                new_students = NewStudentListValidator.parse_obj(
+                    {'students': payload} if isinstance(payload, list) else payload).students
+            else:
+                new_students = [NewStudentValidator.parse_obj(payload)]
+        except ValidationError as err:
+            return err.json(), 200
+
+        group_ids = {student.group_id for student in new_students if student.group_id is not None}
+        new_rows = [student.dict() for student in new_students]
+        async with engine.begin() as conn:
+            abort_missing(groups=await conn.run_sync(missing_ids, GroupModel.id, group_ids))
+            new_ids = await conn.run_sync(lambda sync_conn: insert_returning_ids(
+                sync_conn, sync_conn, StudentModel.__table__, new_rows, api.config['STUDENTS_BATCH_SIZE']))
+            await api.mark_changed(conn, 'students')
+
+        if batch:
+            return {'message': 'Students added successfully', 'ids': new_ids}, 201
+        return {'message': 'Student added successfully', 'id': new_ids[0]}, 201
+
+    async def delete(self, api, request, engine, student_id):
+        """Delete student by ID. Attendings are removed by the database cascade"""
+        async with engine.begin() as conn:
+            await conn.execute(delete(StudentModel).where(StudentModel.id == student_id))
+            await api.mark_changed(conn, 'students', 'attending')
+        return '', 204
+
+
+class StudentSearch:
+    @read_only
+    async def get(self, api, request, engine):
+        """Output students with a first or last name starting with or containing 'q', prefix matches first.
+        SQLite is searched with SQL here, without the in-memory index of the WSGI app"""
+        text = request.args.get('q', default='').strip()
+        if not text:
+            abort(400, message='Parameter <q> is required')
+        limit = request.args.get('limit', type=int, default=api.config['SEARCH_LIMIT'])
+        limit = max(1, min(limit, api.config['MAX_PAGE_SIZE']))
+        async with engine.connect() as conn:
+            rows = await conn.run_sync(lambda sync_conn: search_students(
+                sync_conn, engine.dialect.name, text, student_columns, limit, api.config['SEARCH_MIN_SUBSTRING']))
+        keys = [column.name for column in student_columns]
+        return {'students': [dict(zip(keys, row)) for row in rows]}, 200
+
+
+class StudentsBatchDelete:
+    async def post(self, api, request, engine):
+        """Delete students from list of IDs in one statement. Output the outcome of every ID"""
+        try:
+            student_ids = StudentIdsValidator.parse_obj(request.get_json()).ids
+        except ValidationError as err:
+            return err.json(), 200
+        async with engine.begin() as conn:
+            results = await conn.run_sync(lambda sync_conn: delete_students(sync_conn, sync_conn, student_ids))
+            await api.mark_changed(conn, 'students', 'attending')
+        return {'results': results}, 200
+
+
+class CoursesBatchDelete:
+    async def post(self, api, request, engine):
+        """Delete students from courses from list in one statement. Output the outcome of every pair"""
+        try:
+            attendings = CourseListValidator.parse_obj(request.get_json()).attending_list
+        except ValidationError as err:
+            return err.json(), 200
+        pairs = [(row.student_id, row.course_id) for row in attendings]
+        async with engine.begin() as conn:
+            results = await conn.run_sync(lambda sync_conn: delete_attendings(sync_conn, sync_conn, pairs))
+            await api.mark_changed(conn, 'attending')
+        return {'results': results}, 200
+
+
+class GroupMembers:
+    async def post(self, api, request, engine, group_id):
+        """Move students from list of IDs to the group, all of them or none if the group would be too big"""
+        try:
+            student_ids = StudentIdsValidator.parse_obj(request.get_json()).ids
+        except ValidationError as err:
+            return err.json(), 200
+        async with engine.begin() as conn:
+            results = await conn.run_sync(lambda sync_conn: move_students(sync_conn, group_id, student_ids,
+                                                                          MAX_GROUP_SIZE))
+            await api.mark_changed(conn, 'students', 'groups')
+        return {'results': results}, 200
+
+
+class GroupsAutoAssign:
+    async def post(self, api, request, engine):
+        """Assign all students without a group to the least filled groups, adding groups when they are full.
+        Output the plan, applied unless 'dry_run'"""
+        try:
+            options = AutoAssignValidator.parse_obj(request.get_json() or {})
+        except ValidationError as err:
+            return err.json(), 200
+        max_size = options.max_size or MAX_GROUP_SIZE
+        if max_size > MAX_GROUP_SIZE:
+            abort(400, message=f'Parameter <max_size> can not exceed {MAX_GROUP_SIZE}')
+        async with engine.begin() as conn:
+            plan = await conn.run_sync(lambda sync_conn: auto_assign(
+                sync_conn, sync_conn, max_size, options.dry_run, api.config['STUDENTS_BATCH_SIZE']))
+            if not options.dry_run:
+                await api.mark_changed(conn, 'students', 'groups')
+        return assignment_result(plan, options.dry_run), 200
+
+
+class Export:
+    async def get(self, api, request, engine, table_name):
+        """Stream all rows of the table as NDJSON or CSV"""
+        export_format = request.args.get('format', default='ndjson')
+        if table_name not in EXPORT_TABLES:
+            abort(404, message=f'Table <{table_name}> can not be exported')
+        if export_format not in MEDIA_TYPES:
+            abort(400, message=f'Format <{export_format}> is not supported, use one of: {", ".join(MEDIA_TYPES)}')
+        table = EXPORT_TABLES[table_name]
+        return StreamingResponse(self.chunks(engine, table, export_format, api.config['EXPORT_BATCH_SIZE']),
+                                 MEDIA_TYPES[export_format],
+                                 [('content-disposition', f'attachment; filename={table_name}.{export_format}')])
+
+    @staticmethod
+    async def chunks(engine, table, export_format, batch_size):
+        header, lines = FORMATTERS[export_format]
+        yield header(table)
+        statement = select(table).order_by(*table.primary_key.columns)
+        async with engine.connect() as conn:
+            result = await conn.stream(statement.execution_options(max_row_buffer=batch_size))
+            async for rows in result.partitions(batch_size):
+                yield lines(table, rows)
+
+
+RESOURCES = {
+    'students': Students(),
+    'student_search': StudentSearch(),
+    'students_batch_delete': StudentsBatchDelete(),
+    'groups': Groups(),
+    'group_members': GroupMembers(),
+    'groups_auto_assign': GroupsAutoAssign(),
+    'courses': Courses(),
+    'courses_batch_delete': CoursesBatchDelete(),
+    'export': Export(),
+}
+
+
+def resource_rules(endpoint, *paths):
+    methods = [method.upper() for method in ('get', 'post', 'put', 'delete') if hasattr(RESOURCES[endpoint], method)]
+    return [Rule(path, endpoint=endpoint, methods=methods) for path in paths]
+
+
+URL_MAP = Map(resource_rules('students', '/api/v1/students/', '/api/v1/students/<int:student_id>')
+              + resource_rules('student_search', '/api/v1/students/search')
+              + resource_rules('students_batch_delete', '/api/v1/students/batch-delete')
+              + resource_rules('groups', '/api/v1/groups/')
+              + resource_rules('group_members', '/api/v1/groups/<int:group_id>/members')
+              + resource_rules('groups_auto_assign', '/api/v1/groups/auto-assign')
+              + resource_rules('courses', '/api/v1/courses/', '/api/v1/courses/<string:course_name>')
+              + resource_rules('courses_batch_delete', '/api/v1/courses/batch-delete')
+              + resource_rules('export', '/api/v1/export/<string:table_name>'))
+
+
+class AsgiApi:
+    """ASGI application of the v1 API"""
+
+    def __init__(self, config_object):
+        self.config = Config('.')
+        self.config.from_object(config_object)
+        self.engine = create_engine_from(self.config, self.config['SQLALCHEMY_DATABASE_URI'])
+        replica_uri = self.config.get('REPLICA_URI')
+        self.replica_engine = create_engine_from(self.config, replica_uri) if replica_uri else None
+        self.replica_down_until = 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        response = await self.dispatch(scope, Request(scope, body))
+        await response.send(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispose(self):
+        await self.engine.dispose()
+        if self.replica_engine is not None:
+            await self.replica_engine.dispose()
+
+    async def dispatch(self, scope, request):
+        host = request.headers.get('host', 'localhost')
+        urls = URL_MAP.bind(host, path_info=request.path, url_scheme=scope.get('scheme', 'http'),
+                            query_args=scope['query_string'].decode('latin-1'))
+        try:
+            endpoint, kwargs = urls.match(method=request.method)
+            handler = getattr(RESOURCES[endpoint], request.method.lower())
+            result = await self.call(handler, request, kwargs)
+        except RequestRedirect as redirect:
+            response = redirect.get_response()
+            return Response(response.get_data(), response.status_code, response.headers.items())
+        except HTTPException as err:
+            data = getattr(err, 'data', None) or {'message': err.description}
+            return json_response(data, err.code, self.config)
+        if isinstance(result, StreamingResponse):
+            return result
+        data, status = result
+        return json_response(data, status, self.config)
+
+    async def call(self, handler, request, kwargs):
+        """Run read-only handlers on the replica, and on the primary when the replica fails"""
+        if getattr(handler, 'read_only', False) and self.replica_engine is not None \
+                and time.monotonic() >= self.replica_down_until:
+            try:
+                return await handler(self, request, self.replica_engine, **kwargs)
+            except OperationalError as error:
+                logger.warning('Read replica failed, using the primary: %s', error.orig)
+                self.replica_down_until = time.monotonic() + self.config['REPLICA_RETRY_SECONDS']
+        return await handler(self, request, self.engine, **kwargs)
+
+    async def mark_changed(self, conn, *tables):
+        """Bump versions of the tables within the writing transaction when the cache keeps them in the database"""
+        if self.config.get('CACHE_BACKEND') != 'database':
+            return
+        # The async drivers are those of PostgreSQL and SQLite, which both have upserts
+        await conn.execute(insert_or_increment(table_versions, conn, 'version'),
+                           [{'table_name': table, 'version': 1} for table in sorted(tables)])
+
+
+app = AsgiApi(BaseConfig)
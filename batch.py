@@ -0,0 +1,84 @@
+from flask_restful import abort
+from sqlalchemy import select, tuple_
+
+from dialects import delete_returning
+from models import GroupModel, StudentModel, attending
+
+
+def missing_ids(conn, column, ids):
+    """Sorted IDs of 'ids' not found in 'column'. Only the distinct IDs are sent, in one statement"""
+    ids = set(ids)
+    if not ids:
+        return []
+    found = {found_id for found_id, in conn.execute(select(column).where(column.in_(ids)))}
+    return sorted(ids - found)
+
+
+def abort_missing(**missing):
+    """Abort with 404 naming every missing ID, given by table name, when there are any"""
+    missing = {table: ids for table, ids in missing.items() if ids}
+    if missing:
+        abort(404, message='; '.join(f'{table.capitalize()} with IDs <{", ".join(map(str, ids))}> do not exist'
+                                     for table, ids in missing.items()),
+              missing=missing)
+
+
+def delete_students(session, bind, student_ids):
+    """Delete students by ID in one statement. Return the outcome of every ID in the given order"""
+    student_ids = list(dict.fromkeys(student_ids))
+    deleted = set()
+    if student_ids:
+        deleted = {student_id for student_id, in delete_returning(session, bind, StudentModel.__table__,
+                                                                  StudentModel.id.in_(student_ids), StudentModel.id)}
+    return [{'id': student_id, 'outcome': 'deleted' if student_id in deleted else 'not_found'}
+            for student_id in student_ids]
+
+
+def delete_attendings(session, bind, pairs):
+    """Delete (student_id, course_id) pairs in one statement. Return the outcome of every pair in the given order"""
+    pairs = list(dict.fromkeys(pairs))
+    deleted = set()
+    if pairs:
+        key = tuple_(attending.c.student_id, attending.c.course_id)
+        deleted = {tuple(row) for row in delete_returning(session, bind, attending, key.in_(pairs),
+                                                          attending.c.student_id, attending.c.course_id)}
+    return [{'student_id': student_id, 'course_id': course_id,
+             'outcome': 'deleted' if (student_id, course_id) in deleted else 'not_found'}
+            for student_id, course_id in pairs]
+
+
+def move_students(session, group_id, student_ids, max_group_size):
+    """Move students to the group in one statement, or none of them if the group would exceed 'max_group_size'.
+    Return the outcome of every ID in the given order"""
+    student_ids = list(dict.fromkeys(student_ids))
+    # Rows are locked in ID order, so concurrent moves of overlapping students wait instead of deadlocking
+    current_groups = dict(session.execute(select(StudentModel.id, StudentModel.group_id)
+                                          .where(StudentModel.id.in_(student_ids))
+                                          .order_by(StudentModel.id)
+                                          .with_for_update()).all())
+    moving = [student_id for student_id in student_ids
+              if student_id in current_groups and current_groups[student_id] != group_id]
+    # The counter triggers update the left groups too, they are locked with the target in the same order
+    locked_groups = {group_id} | ({current_groups[student_id] for student_id in moving} - {None})
+    sizes = dict(session.execute(select(GroupModel.id, GroupModel.students_count)
+                                 .where(GroupModel.id.in_(locked_groups))
+                                 .order_by(GroupModel.id)
+                                 .with_for_update()).all())
+    if group_id not in sizes:
+        abort(404, message=f'Group with ID <{group_id}> does not exist')
+    new_size = sizes[group_id] + len(moving)
+    if new_size > max_group_size:
+        abort(409, message=f'Group with ID <{group_id}> would have {new_size} students, '
+                           f'the maximum is {max_group_size}')
+    if moving:
+        session.execute(StudentModel.__table__.update()
+                        .where(StudentModel.id.in_(moving))
+                        .values(group_id=group_id))
+
+    moved = set(moving)
+
+    def outcome(student_id):
+        if student_id not in current_groups:
+            return 'not_found'
+        return 'moved' if student_id in moved else 'already_member'
+    return [{'id': student_id, 'outcome': outcome(student_id)} for student_id in student_ids]
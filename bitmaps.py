@@ -0,0 +1,188 @@
+import numpy as np
+from sqlalchemy import exists, func, select
+
+from analytics import NO_GROUP, read_int_rows
+from models import GroupModel, StudentModel, CourseModel, attending
+
+
+def to_bitmap(ids, capacity):
+    """Bitmap of 'capacity' bits, the ones of 'ids' set, packed eight to a byte in little bit order"""
+    bits = np.zeros(capacity, bool)
+    bits[ids] = True
+    return np.packbits(bits, bitorder='little')
+
+
+def bitmap_ids(bitmap):
+    """Sorted IDs of the set bits"""
+    return np.flatnonzero(np.unpackbits(bitmap, bitorder='little'))
+
+
+def set_bits(bitmap, ids):
+    np.bitwise_or.at(bitmap, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+
+
+def clear_bits(bitmap, ids):
+    np.bitwise_and.at(bitmap, ids >> 3, ~(1 << (ids & 7)).astype(np.uint8))
+
+
+def grown(array, size):
+    return np.concatenate((array, np.zeros(size - len(array), array.dtype)))
+
+
+class RosterIndex:
+    """Students of every course and of every group, for set queries without joins.
+    Students are a bitmap and groups an array of the group of every student ID, groups are a partition of the students.
+    A course is a sorted array of student IDs while that is smaller than a bitmap of all IDs, a bitmap otherwise"""
+
+    def __init__(self, students, attendings, courses, groups, versions):
+        """'students' are (id, group_id or NO_GROUP) rows and 'attendings' (course_id, student_id) rows in that order,
+        'courses' and 'groups' (id, name) rows"""
+        self.versions = versions
+        self.course_ids = {name: course_id for course_id, name in courses}
+        # 'none' selects the students without a group
+        self.group_ids = dict({name: group_id for group_id, name in groups}, none=NO_GROUP)
+        max_id = max(int(students[:, 0].max()) if len(students) else 0,
+                     int(attendings[:, 1].max()) if len(attendings) else 0)
+        self.capacity = self.rounded_capacity(max_id + 1)
+        self.students = to_bitmap(students[:, 0], self.capacity)
+        self.group_of = np.zeros(self.capacity, np.int32)
+        self.group_of[students[:, 0]] = students[:, 1]
+        course_ids = np.array([course_id for course_id, _ in courses], np.int64)
+        starts = np.searchsorted(attendings[:, 0], course_ids)
+        ends = np.searchsorted(attendings[:, 0], course_ids, side='right')
+        self.courses = {course_id: self.container(attendings[start:end, 1].astype(np.uint32))
+                        for course_id, start, end in zip(course_ids.tolist(), starts, ends)}
+
+    @staticmethod
+    def rounded_capacity(size):
+        return -(-size // 64) * 64
+
+    def container(self, ids):
+        """Sorted array of 'ids', or their bitmap when that takes less memory"""
+        if len(ids) * 4 > self.capacity // 8:
+            return to_bitmap(ids, self.capacity)
+        return ids
+
+    def ensure_capacity(self, max_id):
+        if max_id < self.capacity:
+            return
+        self.capacity = self.rounded_capacity(max(self.capacity * 2, max_id + 1))
+        self.students = grown(self.students, self.capacity // 8)
+        self.group_of = grown(self.group_of, self.capacity)
+        for course_id, members in self.courses.items():
+            if members.dtype == np.uint8:
+                self.courses[course_id] = grown(members, self.capacity // 8)
+
+    def course_bitmap(self, course_id):
+        members = self.courses[course_id]
+        return members if members.dtype == np.uint8 else to_bitmap(members, self.capacity)
+
+    def select(self, all_courses=(), any_courses=(), no_courses=(), groups=(), no_groups=()):
+        """Bitmap of the students taking every course of 'all_courses', one of 'any_courses' at least and none of
+        'no_courses', in one of 'groups' if given and in none of 'no_groups'. Groups may include NO_GROUP"""
+        result = self.students.copy()
+        for course_id in all_courses:
+            result &= self.course_bitmap(course_id)
+        if any_courses:
+            result &= np.bitwise_or.reduce([self.course_bitmap(course_id) for course_id in any_courses])
+        for course_id in no_courses:
+            result &= ~self.course_bitmap(course_id)
+        if groups:
+            result &= np.packbits(np.isin(self.group_of, list(groups)), bitorder='little')
+        if no_groups:
+            result &= ~np.packbits(np.isin(self.group_of, list(no_groups)), bitorder='little')
+        return result
+
+    def page(self, bitmap, after_id, limit):
+        """Up to 'limit' IDs of the bitmap greater than 'after_id', and the amount of IDs in it"""
+        student_ids = bitmap_ids(bitmap)
+        start = np.searchsorted(student_ids, after_id, side='right')
+        return student_ids[start:start + limit].tolist(), len(student_ids)
+
+    def add_students(self, rows):
+        """Add students from (id, group_id) rows, group_id may be None"""
+        if not rows:
+            return
+        student_ids = np.array([student_id for student_id, _ in rows], np.uint32)
+        self.ensure_capacity(int(student_ids.max()))
+        set_bits(self.students, student_ids)
+        self.group_of[student_ids] = [NO_GROUP if group_id is None else int(group_id) for _, group_id in rows]
+
+    def delete_students(self, student_ids):
+        student_ids = np.unique(np.array(student_ids, np.uint32))
+        student_ids = student_ids[student_ids < self.capacity]
+        clear_bits(self.students, student_ids)
+        self.group_of[student_ids] = NO_GROUP
+        for course_id in self.courses:
+            self.remove_members(course_id, student_ids)
+
+    def move_students(self, student_ids, group_id):
+        student_ids = np.array(student_ids, np.uint32)
+        self.group_of[student_ids[student_ids < self.capacity]] = group_id
+
+    def enroll(self, pairs):
+        """Add (student_id, course_id) pairs"""
+        for course_id, student_ids in self.by_course(pairs).items():
+            self.ensure_capacity(int(student_ids.max()))
+            members = self.courses[course_id]
+            if members.dtype == np.uint8:
+                set_bits(members, student_ids)
+            else:
+                self.courses[course_id] = self.container(np.union1d(members, student_ids))
+
+    def unenroll(self, pairs):
+        """Remove (student_id, course_id) pairs"""
+        for course_id, student_ids in self.by_course(pairs).items():
+            self.remove_members(course_id, student_ids[student_ids < self.capacity])
+
+    def remove_members(self, course_id, student_ids):
+        members = self.courses[course_id]
+        if members.dtype == np.uint8:
+            clear_bits(members, student_ids)
+        else:
+            self.courses[course_id] = np.setdiff1d(members, student_ids, assume_unique=True)
+
+    def by_course(self, pairs):
+        """Student IDs of the pairs by course, for courses in the index"""
+        student_ids = {}
+        for student_id, course_id in pairs:
+            if course_id in self.courses:
+                student_ids.setdefault(course_id, []).append(student_id)
+        return {course_id: np.unique(np.array(ids, np.uint32)) for course_id, ids in student_ids.items()}
+
+    def memory(self):
+        """Bytes taken by the students, groups and courses"""
+        courses = [members.nbytes for members in self.courses.values()]
+        return {'students': self.students.nbytes, 'groups': self.group_of.nbytes, 'courses': sum(courses),
+                'course_bitmaps': sum(1 for members in self.courses.values() if members.dtype == np.uint8),
+                'course_arrays': sum(1 for members in self.courses.values() if members.dtype != np.uint8)}
+
+
+def build_index(connection, versions):
+    """RosterIndex of the data seen by 'connection'"""
+    students = read_int_rows(connection, select(StudentModel.id, func.coalesce(StudentModel.group_id, NO_GROUP))
+                             .order_by(StudentModel.id), 2)
+    attendings = read_int_rows(connection, select(attending.c.course_id, attending.c.student_id)
+                               .order_by(attending.c.course_id, attending.c.student_id), 2)
+    courses = connection.execute(select(CourseModel.id, CourseModel.course_name).order_by(CourseModel.id)).all()
+    groups = connection.execute(select(GroupModel.id, GroupModel.name)).all()
+    return RosterIndex(students, attendings, courses, groups, versions)
+
+
+def equivalent_query(all_courses=(), any_courses=(), no_courses=(), groups=(), no_groups=()):
+    """SELECT of the IDs RosterIndex.select() returns for the same arguments, in ID order"""
+    def taking(course_ids):
+        return exists().where(attending.c.student_id == StudentModel.id, attending.c.course_id.in_(course_ids))
+
+    def in_groups(group_ids):
+        return func.coalesce(StudentModel.group_id, NO_GROUP).in_(group_ids)
+
+    conditions = [taking([course_id]) for course_id in all_courses]
+    if any_courses:
+        conditions.append(taking(any_courses))
+    conditions += [~taking([course_id]) for course_id in no_courses]
+    if groups:
+        conditions.append(in_groups(groups))
+    if no_groups:
+        conditions.append(~in_groups(no_groups))
+    return select(StudentModel.id).where(*conditions).order_by(StudentModel.id)
@@ -0,0 +1,166 @@
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from dialects import insert_or_increment
+from models import db, table_versions
+from replica import primary
+
+# session.info key with the versions backend and the tables changed by the uncommitted transaction
+CHANGED_TABLES = 'changed_tables'
+
+
+class LocalVersions:
+    """Table versions kept in the memory of the process, changed only by its own writes"""
+    name = 'local'
+    shared = False
+
+    def __init__(self):
+        # Versions start over with the process, the epoch keeps them apart from the ones of earlier processes
+        self.epoch = uuid.uuid4().hex
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, tables):
+        return tuple(self._versions.get(table, 0) for table in tables)
+
+    def bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def committed(self, tables):
+        # Values computed between the first bump and the commit may hold the old data
+        self.bump(tables)
+
+
+class DatabaseVersions:
+    """Table versions kept in the 'table_versions' table and changed in the writing transaction,
+    so every process using the database sees them"""
+    name = 'database'
+    shared = True
+    epoch = ''
+
+    def get(self, tables):
+        versions = dict(db.session
+                        .query(table_versions.c.table_name, table_versions.c.version)
+                        .filter(table_versions.c.table_name.in_(tables)))
+        return tuple(versions.get(table, 0) for table in tables)
+
+    def bump(self, tables):
+        upsert = insert_or_increment(table_versions, db.session.get_bind(), 'version')
+        if upsert is not None:
+            db.session.execute(upsert, [{'table_name': table, 'version': 1} for table in sorted(tables)])
+            return
+        for table in sorted(tables):
+            updated = db.session.execute(table_versions.update()
+                                         .where(table_versions.c.table_name == table)
+                                         .values(version=table_versions.c.version + 1)).rowcount
+            if not updated:
+                db.session.execute(table_versions.insert().values(table_name=table, version=1))
+
+    def committed(self, tables):
+        pass
+
+
+VERSIONS_BACKENDS = {
+    'local': LocalVersions,
+    'database': DatabaseVersions,
+}
+
+
+class CacheState:
+    def __init__(self, versions, max_entries):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+class AggregateCache:
+    """LRU cache of query results keyed by name and parameters. An entry is valid while versions of the tables
+    it was computed from stay the same. Write paths call mark_changed() with the tables they modify"""
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_ENABLED', True)
+        app.config.setdefault('CACHE_BACKEND', 'database')
+        app.config.setdefault('CACHE_MAX_ENTRIES', 256)
+        versions = VERSIONS_BACKENDS[app.config['CACHE_BACKEND']]()
+        if not versions.shared:
+            app.logger.warning("Versions of the '%s' cache backend miss the writes of other processes, "
+                               "use CACHE_BACKEND = 'database' with several workers", versions.name)
+        app.extensions['aggregate_cache'] = CacheState(versions, app.config['CACHE_MAX_ENTRIES'])
+
+    @property
+    def state(self):
+        return current_app.extensions['aggregate_cache']
+
+    def versions(self, tables):
+        return self.state.versions.get(tables)
+
+    def etag(self, name, params, tables):
+        """Strong entity tag of a response computed from tables, changing with their versions"""
+        versions = self.state.versions
+        key = repr((name, params, versions.epoch, versions.get(tables)))
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def get_or_compute(self, name, params, tables, compute):
+        """Return cached result of compute() for name and params, or compute and store it"""
+        # A lagging read replica would store old results under the new versions
+        with primary():
+            return self._get_or_compute(name, params, tables, compute)
+
+    def _get_or_compute(self, name, params, tables, compute):
+        state = self.state
+        # Results seen through uncommitted writes of this session must not be shared
+        if not current_app.config['CACHE_ENABLED'] or db.session.info.get(CHANGED_TABLES):
+            return compute()
+        key = (name, params)
+        versions = state.versions.get(tables)
+        with state.lock:
+            entry = state.entries.get(key)
+            if entry is not None and entry[0] == versions:
+                state.entries.move_to_end(key)
+                state.hits += 1
+                return entry[1]
+            state.misses += 1
+        value = compute()
+        # A write committed while computing leaves the value without a valid version
+        if state.versions.get(tables) == versions:
+            with state.lock:
+                state.entries[key] = (versions, value)
+                state.entries.move_to_end(key)
+                while len(state.entries) > state.max_entries:
+                    state.entries.popitem(last=False)
+        return value
+
+    def mark_changed(self, *tables):
+        """Invalidate results depending on tables. Call it within the writing transaction"""
+        versions = self.state.versions
+        versions.bump(tables)
+        changed = db.session.info.setdefault(CHANGED_TABLES, (versions, set()))
+        changed[1].update(tables)
+
+    def stats(self):
+        state = self.state
+        return {'backend': state.versions.name, 'entries': len(state.entries),
+                'hits': state.hits, 'misses': state.misses}
+
+
+cache = AggregateCache()
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def finish_changes(session):
+    changed = session.info.pop(CHANGED_TABLES, None)
+    if changed:
+        versions, tables = changed
+        versions.committed(tables)
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+from cache import cache
+from dialects import insert_ignore
+from models import db, attending
+from roster import roster
+
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class Enrollment:
+    __slots__ = ('operation', 'student_id', 'course_id', 'future')
+
+    def __init__(self, operation, student_id, course_id):
+        self.operation = operation
+        self.student_id = student_id
+        self.course_id = course_id
+        self.future = Future()
+
+
+def write_enrollments(session, bind, enrollments):
+    """Apply add and remove operations with at most one INSERT and one DELETE statement.
+    The last operation on a (student_id, course_id) pair decides whether the row is left, as if they ran in order"""
+    last = {}
+    for enrollment in enrollments:
+        last[(enrollment.student_id, enrollment.course_id)] = enrollment.operation
+    added = [{'student_id': student_id, 'course_id': course_id}
+             for (student_id, course_id), operation in last.items() if operation == ADD]
+    removed = [pair for pair, operation in last.items() if operation == REMOVE]
+    if removed:
+        session.execute(attending.delete().where(tuple_(attending.c.student_id, attending.c.course_id).in_(removed)))
+        roster.unenrolled(removed)
+    if added:
+        session.execute(insert_ignore(attending, bind).values(added))
+        roster.enrolled((row['student_id'], row['course_id']) for row in added)
+
+
+class WriterState:
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, enrollment):
+        with self.lock:
+            # A forked worker process inherits the state, but not the thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='enrollment-writer', daemon=True)
+                self.thread.start()
+        self.queue.put(enrollment)
+        return enrollment.future
+
+    def run(self):
+        window = self.app.config['COALESCING_WINDOW_MS'] / 1000
+        max_operations = self.app.config['COALESCING_MAX_OPS']
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + window
+            while len(batch) < max_operations:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            with self.app.app_context():
+                try:
+                    write_enrollments(db.session, db.engine, batch)
+                    cache.mark_changed('attending')
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].future.set_exception(error)
+                return
+            # One failing operation, like a student deleted meanwhile, must not fail the others
+            for enrollment in batch:
+                self.flush([enrollment])
+            return
+        self.batches += 1
+        self.operations += len(batch)
+        for enrollment in batch:
+            enrollment.future.set_result(None)
+
+
+class EnrollmentWriter:
+    """Adds and removes single attendings. With ENROLLMENT_COALESCING the operations of concurrent requests are
+    queued to a background thread, which writes the ones arriving within COALESCING_WINDOW_MS, up to
+    COALESCING_MAX_OPS of them, in one transaction. Each request returns after the transaction of its batch commits"""
+
+    def init_app(self, app):
+        app.config.setdefault('ENROLLMENT_COALESCING', False)
+        app.config.setdefault('COALESCING_WINDOW_MS', 5)
+        app.config.setdefault('COALESCING_MAX_OPS', 500)
+        app.extensions['enrollment_writer'] = WriterState(app)
+
+    @property
+    def state(self):
+        return current_app.extensions['enrollment_writer']
+
+    def add(self, student_id, course_id):
+        self.write(Enrollment(ADD, student_id, course_id))
+
+    def remove(self, student_id, course_id):
+        self.write(Enrollment(REMOVE, student_id, course_id))
+
+    def write(self, enrollment):
+        if not current_app.config['ENROLLMENT_COALESCING']:
+            write_enrollments(db.session, db.engine, [enrollment])
+            cache.mark_changed('attending')
+            db.session.commit()
+            return
+        # Raises the error of the operation when its write failed
+        self.state.submit(enrollment).result()
+
+    def stats(self):
+        state = self.state
+        return {'batches': state.batches, 'operations': state.operations}
+
+
+enrollment_writer = EnrollmentWriter()
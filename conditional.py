@@ -0,0 +1,65 @@
+import functools
+
+from flask import current_app, make_response, request
+
+from cache import cache
+
+
+class HttpCaching:
+    """Entity tags of API responses and Cache-Control headers of HTML pages, so clients and proxies polling
+    unchanged data get a 304 or a stored copy instead of a fresh response"""
+
+    def init_app(self, app):
+        app.config.setdefault('ETAGS_ENABLED', None)
+        app.config.setdefault('API_CACHE_CONTROL', 'no-cache')
+        app.config.setdefault('HTML_CACHE_CONTROL', None)
+        # Versions of the 'local' backend change only with the writes of their own process, so the other
+        # workers would keep answering with a 304 after a write
+        shared = app.config['CACHE_BACKEND'] == 'database'
+        if app.config['ETAGS_ENABLED'] is None:
+            app.config['ETAGS_ENABLED'] = shared
+        elif app.config['ETAGS_ENABLED'] and not shared:
+            app.logger.warning("ETags of the 'local' cache backend are valid in one worker process only, "
+                               "use CACHE_BACKEND = 'database' with several workers")
+
+
+http_caching = HttpCaching()
+
+
+def conditional(*tables):
+    """Answer If-None-Match with a 304 while the tables the resource reads are unchanged.
+    The tag is taken from the table versions before the handler runs, so a response is never
+    tagged newer than its data, and a matching request does not query the tables at all"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            config = current_app.config
+            if not config['ETAGS_ENABLED']:
+                return method(*args, **kwargs)
+            # The representation depends on the encoder and on the indentation of the debug mode
+            params = (request.path, tuple(sorted(request.args.items(multi=True))),
+                      config['API_JSON_ENCODER'], current_app.debug)
+            etag = cache.etag(request.endpoint, params, tables)
+            headers = {'ETag': f'"{etag}"'}
+            if config['API_CACHE_CONTROL']:
+                headers['Cache-Control'] = config['API_CACHE_CONTROL']
+            if request.if_none_match.contains_weak(etag):
+                return current_app.response_class(status=304, headers=headers)
+            data, code = method(*args, **kwargs)
+            if code != 200:
+                return data, code
+            return data, code, headers
+        return wrapper
+    return decorator
+
+
+def cacheable(view):
+    """Send HTML_CACHE_CONTROL with the page, letting a reverse proxy serve it to the next requests"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        cache_control = current_app.config['HTML_CACHE_CONTROL']
+        if cache_control and response.status_code == 200:
+            response.headers['Cache-Control'] = cache_control
+        return response
+    return wrapper
@@ -0,0 +1,34 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from cache import cache
+from models import db, GroupModel, StudentModel, CourseModel, attending
+
+
+def reconcile_counters():
+    """Recount students of every group and enrollments of every course.
+    Return amounts of corrected groups and courses"""
+    students_amount = (select(func.count(StudentModel.id))
+                       .where(StudentModel.group_id == GroupModel.id)
+                       .scalar_subquery())
+    fixed_groups = db.session.execute(GroupModel.__table__.update()
+                                      .where(GroupModel.students_count != students_amount)
+                                      .values(students_count=students_amount)).rowcount
+    enrolled_amount = (select(func.count(attending.c.student_id))
+                       .where(attending.c.course_id == CourseModel.id)
+                       .scalar_subquery())
+    fixed_courses = db.session.execute(CourseModel.__table__.update()
+                                       .where(CourseModel.enrolled_count != enrolled_amount)
+                                       .values(enrolled_count=enrolled_amount)).rowcount
+    cache.mark_changed('groups', 'courses')
+    db.session.commit()
+    return fixed_groups, fixed_courses
+
+
+@click.command('reconcile-counters')
+@with_appcontext
+def reconcile_command():
+    """Repair students_count of groups and enrolled_count of courses"""
+    fixed_groups, fixed_courses = reconcile_counters()
+    click.echo(f'Corrected {fixed_groups} groups and {fixed_courses} courses')
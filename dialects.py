@@ -0,0 +1,137 @@
+import sqlite3
+
+from sqlalchemy import Integer, bindparam, column, event, func, select, values
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+# SQLite runs DELETE ... RETURNING since 3.35, the SQLite dialect of SQLAlchemy 1.4 does not compile it though
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+
+def insert_ignore(table, bind):
+    """INSERT statement that skips rows already present under the table's primary key"""
+    if bind.dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if bind.dialect.name == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('IGNORE')
+
+
+def insert_or_increment(table, bind, counter):
+    """INSERT statement adding 1 to 'counter' of the row already present under the table's primary key instead,
+    None for databases without upserts"""
+    if bind.dialect.name == 'postgresql':
+        statement = postgresql.insert(table)
+    elif bind.dialect.name == 'sqlite':
+        statement = sqlite.insert(table)
+    else:
+        return None
+    return statement.on_conflict_do_update(index_elements=table.primary_key.columns,
+                                           set_={counter: table.c[counter] + 1})
+
+
+def insert_ignore_rows(session, bind, table, rows, batch_size):
+    """Insert rows with insert_ignore() statements of up to 'batch_size' rows each, keeping the bound parameters
+    under the limits of the drivers. Return the amount of inserted rows"""
+    inserted = 0
+    for start in range(0, len(rows), batch_size):
+        inserted += session.execute(insert_ignore(table, bind).values(rows[start:start + batch_size])).rowcount
+    return inserted
+
+
+def insert_returning_ids(session, bind, table, rows, batch_size):
+    """Insert rows with multi-row INSERT statements of up to 'batch_size' rows each.
+    Return generated primary keys in the order of rows"""
+    new_ids = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if bind.dialect.implicit_returning:
+            result = session.execute(table.insert().values(batch).returning(*table.primary_key.columns))
+            new_ids.extend(new_id for new_id, in result)
+        elif bind.dialect.name == 'sqlite' and SQLITE_RETURNING:
+            # SQLite returns the rows in no set order, the rowids of one statement grow with the rows
+            result = session.execute(SqliteReturning(table.insert().values(batch), *table.primary_key.columns))
+            new_ids.extend(sorted(new_id for new_id, in result))
+        else:
+            # Older SQLite assigns consecutive rowids to the rows of one statement
+            last_id = session.execute(table.insert().values(batch)).lastrowid
+            new_ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+    return new_ids
+
+
+class SqliteReturning(Executable, ClauseElement):
+    """'statement' followed by RETURNING 'columns', for SQLite"""
+    inherit_cache = False
+    # Read by the compiler and the execution context of an INSERT, which keep its result open for RETURNING.
+    # The SQLite compiler renders no RETURNING of its own, the rows are read as described by the cursor
+    _inline = False
+    _return_defaults = False
+
+    def __init__(self, statement, *columns):
+        self.statement = statement
+        self.columns = columns
+        self._returning = columns
+
+
+@compiles(SqliteReturning)
+def compile_sqlite_returning(element, compiler, **kw):
+    columns = ', '.join(compiler.preparer.quote(column.name) for column in element.columns)
+    return f'{compiler.process(element.statement, **kw)} RETURNING {columns}'
+
+
+def delete_returning(session, bind, table, whereclause, *columns):
+    """Delete rows matching 'whereclause' in one statement. Return 'columns' of the deleted rows"""
+    if bind.dialect.implicit_returning:
+        return session.execute(table.delete().where(whereclause).returning(*columns)).all()
+    if bind.dialect.name == 'sqlite' and SQLITE_RETURNING:
+        return session.execute(SqliteReturning(table.delete().where(whereclause), *columns)).all()
+    # Without RETURNING the rows are read first, any of them deleted meanwhile by another connection is gone anyway
+    deleted = session.execute(select(*columns).where(whereclause)).all()
+    if deleted:
+        session.execute(table.delete().where(whereclause))
+    return deleted
+
+
+def update_id_ranges(session, bind, table, column_name, ranges, batch_size):
+    """Set 'column_name' to 'value' in rows with an ID between 'first_id' and 'last_id', for each
+    (value, first_id, last_id) of 'ranges'. Rows that already have a value in the column keep it"""
+    key = table.primary_key.columns.values()[0]
+    target = table.c[column_name]
+    # A condition on the column itself could make the planner read all its NULLs through the column's index
+    # for every range, the IDs alone lead it to the primary key
+    if bind.dialect.name == 'postgresql':
+        # UPDATE ... FROM (VALUES ...) joins a batch of ranges to the rows in one statement
+        for start in range(0, len(ranges), batch_size):
+            batch = values(column('value', Integer), column('first_id', Integer), column('last_id', Integer),
+                           name='ranges').data(ranges[start:start + batch_size])
+            session.execute(table.update()
+                            .where(key.between(batch.c.first_id, batch.c.last_id))
+                            .values({target: func.coalesce(target, batch.c.value)}))
+        return
+    # Other databases take no FROM in UPDATE, the ranges are sent with executemany to one statement
+    statement = (table.update()
+                 .where(key.between(bindparam('first_id'), bindparam('last_id')))
+                 .values({target: func.coalesce(target, bindparam('value'))}))
+    for start in range(0, len(ranges), batch_size):
+        session.execute(statement, [{'value': value, 'first_id': first_id, 'last_id': last_id}
+                                    for value, first_id, last_id in ranges[start:start + batch_size]])
+
+
+def sqlite_pragmas(config):
+    """PRAGMA statements of SQLITE_PRAGMAS for every new SQLite connection. Foreign keys are always enforced,
+    SQLite leaves them off unless asked"""
+    pragmas = dict(config.get('SQLITE_PRAGMAS') or {}, foreign_keys='ON')
+    return [f'PRAGMA {name} = {value}' for name, value in pragmas.items()]
+
+
+def listen_sqlite_pragmas(engine, statements):
+    """Run the statements of sqlite_pragmas() on every connection the engine opens"""
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
@@ -0,0 +1,67 @@
+import csv
+import io
+import json
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import select
+
+from models import db, GroupModel, StudentModel, CourseModel, attending
+
+EXPORT_TABLES = {
+    'students': StudentModel.__table__,
+    'groups': GroupModel.__table__,
+    'courses': CourseModel.__table__,
+    'attending': attending,
+}
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_partitions(table, batch_size):
+    """Read all rows of table in primary key order through a server-side cursor, 'batch_size' rows at a time"""
+    statement = (select(table)
+                 .order_by(*table.primary_key.columns)
+                 .execution_options(stream_results=True, max_row_buffer=batch_size))
+    result = db.session.execute(statement)
+    yield from result.partitions(batch_size)
+
+
+def ndjson_lines(table, rows):
+    keys = table.columns.keys()
+    return ''.join(json.dumps(dict(zip(keys, row)), ensure_ascii=False) + '\n' for row in rows)
+
+
+def csv_lines(table, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def csv_header(table):
+    return csv_lines(table, [table.columns.keys()])
+
+
+# Header and rows formatters of every format
+FORMATTERS = {
+    'ndjson': (lambda table: '', ndjson_lines),
+    'csv': (csv_header, csv_lines),
+}
+
+
+def export_chunks(table, export_format, partitions):
+    header, lines = FORMATTERS[export_format]
+    yield header(table)
+    for rows in partitions:
+        yield lines(table, rows)
+
+
+def export_response(table_name, export_format):
+    """Streamed response with all rows of table, memory use is bounded by EXPORT_BATCH_SIZE rows"""
+    table = EXPORT_TABLES[table_name]
+    chunks = export_chunks(table, export_format, iter_partitions(table, current_app.config['EXPORT_BATCH_SIZE']))
+    response = Response(stream_with_context(chunks), mimetype=MEDIA_TYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={table_name}.{export_format}'
+    return response
@@ -1,78 +1,216 @@
+import bisect
+import csv
+import io
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, func
+
+from cache import cache
+from grouping import GROUP_NAMES_COUNT, group_name
 from models import db, GroupModel, StudentModel, CourseModel, attending
 
+# Students are generated in blocks with their own random state, so the data depends only on the seed when one is given
+BLOCK_SIZE = 10000
+
+FIRST_NAMES = ['Jay', 'Jim', 'Roy', 'Axel', 'Billy', 'Charlie', 'Gina', 'Paul', 'Ally', 'Nicky', 'Carl',
+               'Lauren', 'Arthur', 'Ashley', 'Drake', 'Kim', 'Lorraine', 'Janet', 'Charles', 'Bradley']
+LAST_NAMES = ['Barker', 'Spirits', 'Murphy', 'Smith', 'Stone', 'Rogers', 'Warren', 'Keller', 'James', 'Cook',
+              'Fletcher', 'Crow', 'Jackson', 'Lopez', 'Li', 'Thompson', 'Lens', 'Walles', 'Tailor', 'Swift']
+COURSES = {'Math': 'Math auditorium',
+           'Biology': 'Biology auditorium',
+           'English': 'English auditorium',
+           'Programming': 'Programming auditorium',
+           'History': 'History auditorium',
+           'Psychology': 'Psychology auditorium',
+           'Design': 'Design auditorium',
+           'Chemistry': 'Chemistry auditorium',
+           'Physics': 'Physics auditorium',
+           'Music': 'Music auditorium'}
 
-def generate_groups():
-    groups = []
-    for _ in range(10):
-        name = ''.join([chr(random.randint(65, 90)) for _ in range(2)])+'-'+str(random.randint(1, 99)).zfill(2)
-        groups.append(GroupModel(name=name))
-    db.session.add_all(groups)
-    db.session.commit()
 
+def course_names():
+    """Endless sequence of course names: 'Math', ..., 'Music', 'Math 2', ..."""
+    number = 1
+    while True:
+        for course_name in COURSES:
+            yield course_name if number == 1 else f'{course_name} {number}'
+        number += 1
 
-def create_courses():
-    data = {'Math': 'Math auditorium',
-               'Biology': 'Biology auditorium',
-               'English': 'English auditorium',
-               'Programming': 'Programming auditorium',
-               'History': 'History auditorium',
-               'Psychology': 'Psychology auditorium',
-               'Design': 'Design auditorium',
-               'Chemistry': 'Chemistry auditorium',
-               'Physics': 'Physics auditorium',
-               'Music': 'Music auditorium'}
-    courses = []
-    for course_name, description in data.items():
-        courses.append(CourseModel(course_name=course_name, description=description))
-    db.session.add_all(courses)
+
+def generate_groups(count, rng):
+    existing_names = {name for name, in db.session.query(GroupModel.name)}
+    free_numbers = [number for number in range(GROUP_NAMES_COUNT) if group_name(number) not in existing_names]
+    if count > len(free_numbers):
+        raise click.UsageError(f'Only {len(free_numbers)} more unique group names are available')
+    db.session.execute(GroupModel.__table__.insert(),
+                       [{'name': group_name(number)} for number in rng.sample(free_numbers, count)])
     db.session.commit()
 
 
-def generate_students():
-    first_names = ['Jay', 'Jim', 'Roy', 'Axel', 'Billy', 'Charlie', 'Gina', 'Paul', 'Ally', 'Nicky', 'Carl',
-                   'Lauren', 'Arthur', 'Ashley', 'Drake', 'Kim', 'Lorraine', 'Janet', 'Charles', 'Bradley']
-    last_names = ['Barker', 'Spirits', 'Murphy', 'Smith', 'Stone', 'Rogers', 'Warren', 'Keller', 'James', 'Cook',
-                  'Fletcher', 'Crow', 'Jackson', 'Lopez', 'Li', 'Thompson', 'Lens', 'Walles', 'Tailor', 'Swift']
+def create_courses(count):
+    existing_names = {course_name for course_name, in db.session.query(CourseModel.course_name)}
+    rows = []
+    for course_name in course_names():
+        if len(rows) == count:
+            break
+        if course_name not in existing_names:
+            base_name = course_name.split(' ')[0]
+            rows.append({'course_name': course_name, 'description': COURSES[base_name]})
+    db.session.execute(CourseModel.__table__.insert(), rows)
+    db.session.commit()
 
-    def next_student(group_id):
-        first_name = random.choice(first_names)
-        last_name = random.choice(last_names)
-        return StudentModel(group_id=group_id, first_name=first_name, last_name=last_name)
 
-    students = []
-    group_ids = db.session.query(GroupModel.id).all()
-    count = 0
+def plan_groups(group_ids, students_count, rng):
+    """Fill groups with 10-30 students each until students run out. The rest of the students stay ungrouped.
+    Return group IDs and the cumulative amount of students that ends each group"""
+    planned_ids, bounds = [], []
+    total = 0
     for group_id in group_ids:
-        for student in range(random.randint(10, 30)):
-            count += 1
-            if count > 200:
-                break
-            students.append(next_student(group_id[0]))
-    while count < 200:
-        count += 1
-        students.append(next_student(None))
-    db.session.add_all(students)
-    db.session.commit()
+        if total >= students_count:
+            break
+        total = min(total + rng.randint(10, 30), students_count)
+        planned_ids.append(group_id)
+        bounds.append(total)
+    return planned_ids, bounds
+
+
+def generate_block(plan, block_start):
+    """Rows of students and their attendings for one block of the plan"""
+    rng = random.Random(f'{plan["seed"]}-{block_start}' if plan['seed'] is not None else None)
+    group_ids, bounds, course_ids = plan['group_ids'], plan['bounds'], plan['course_ids']
+    students, attendings = [], []
+    for number in range(block_start, min(block_start + BLOCK_SIZE, plan['students'])):
+        student_id = plan['base_id'] + number + 1
+        position = bisect.bisect_right(bounds, number)
+        group_id = group_ids[position] if position < len(group_ids) else None
+        students.append((student_id, group_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)))
+        for course_id in rng.sample(course_ids, min(rng.randint(1, 3), len(course_ids))):
+            attendings.append((student_id, course_id))
+    return students, attendings
+
+
+def copy_rows(connection, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def execute_rows(connection, table, columns, rows):
+    """Rows as parameters of one prepared INSERT, passed to the driver as they are"""
+    cursor = connection.connection.cursor()
+    cursor.executemany(f'INSERT INTO {table.name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                       rows)
+
+
+def insert_rows(connection, table, columns, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows[start:start + batch_size]])
 
 
-def generate_attending():
-    """ Generate all references besides students and courses and commit them one by one"""
-    student_ids = db.session.query(StudentModel.id).all()
-    course_ids = db.session.query(CourseModel.id).all()
-    for student_id in student_ids:
-        attends_amount = random.randint(1, 3)
-        for course_id in random.sample(course_ids, attends_amount):
-            new_attending = attending.insert().values(course_id=course_id[0], student_id=student_id[0])
-            db.session.execute(new_attending)
-            db.session.commit()
+def write_block(engine, plan, block_start):
+    """Generate one block and write it in its own transaction, with COPY on PostgreSQL
+    and with the executemany() of the driver on SQLite"""
+    students, attendings = generate_block(plan, block_start)
+    with engine.begin() as connection:
+        for table, columns, rows in ((StudentModel.__table__, ('id', 'group_id', 'first_name', 'last_name'), students),
+                                     (attending, ('student_id', 'course_id'), attendings)):
+            if engine.dialect.name == 'postgresql':
+                copy_rows(connection, table, columns, rows)
+            elif engine.dialect.name == 'sqlite':
+                execute_rows(connection, table, columns, rows)
+            else:
+                insert_rows(connection, table, columns, rows, plan['batch_size'])
+    return len(students), len(attendings)
+
+
+_worker = {}
+
+
+def init_worker(database_uri, plan):
+    _worker['engine'] = create_engine(database_uri)
+    _worker['plan'] = plan
+
+
+def write_worker_block(block_start):
+    return write_block(_worker['engine'], _worker['plan'], block_start)
+
+
+def generate_students(plan, workers):
+    """Write all planned students and attendings, split in blocks across a pool of worker processes"""
+    blocks = range(0, plan['students'], BLOCK_SIZE)
+    # SQLite writes one transaction at a time, more processes would wait for each other
+    if workers > 1 and db.engine.dialect.name != 'sqlite':
+        database_uri = db.engine.url.render_as_string(hide_password=False)
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(database_uri, plan)) as executor:
+            counts = list(executor.map(write_worker_block, blocks))
+    else:
+        counts = [write_block(db.engine, plan, block_start) for block_start in blocks]
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute("SELECT setval(pg_get_serial_sequence('students', 'id'), max(id)) FROM students")
+        db.session.commit()
+    return sum(students for students, _ in counts), sum(attendings for _, attendings in counts)
+
+
+def create_all_data(students=200, groups=10, courses=10, seed=None, workers=1, batch_size=10000):
+    """Generate groups, courses, students and their attendings in bulk.
+    Return amount of rows and seconds spent per table"""
+    rng = random.Random(seed)
+    stats = {}
+
+    started = time.perf_counter()
+    group_ids_before = {group_id for group_id, in db.session.query(GroupModel.id)}
+    generate_groups(groups, rng)
+    stats['groups'] = (groups, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    course_ids_before = {course_id for course_id, in db.session.query(CourseModel.id)}
+    create_courses(courses)
+    stats['courses'] = (courses, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    group_ids = sorted(set(group_id for group_id, in db.session.query(GroupModel.id)) - group_ids_before)
+    planned_ids, bounds = plan_groups(group_ids, students, rng)
+    plan = {
+        'seed': seed,
+        'students': students,
+        'base_id': db.session.query(func.coalesce(func.max(StudentModel.id), 0)).scalar(),
+        'group_ids': planned_ids,
+        'bounds': bounds,
+        'course_ids': sorted(set(course_id for course_id, in db.session.query(CourseModel.id)) - course_ids_before),
+        'batch_size': batch_size,
+    }
+    db.session.commit()
+    students_count, attendings_count = generate_students(plan, workers)
+    cache.mark_changed('groups', 'courses', 'students', 'attending')
+    db.session.commit()
+    # Students and their attendings are written in the same transactions, so they share one rate
+    stats['students and attending'] = (students_count + attendings_count, time.perf_counter() - started)
+    return stats
 
 
-def create_all_data():
-    generate_groups()
-    create_courses()
-    generate_students()
-    generate_attending()
+@click.command('generate')
+@click.option('--students', default=200, show_default=True, help='Amount of students')
+@click.option('--groups', default=10, show_default=True, help='Amount of groups')
+@click.option('--courses', default=10, show_default=True, help='Amount of courses')
+@click.option('--seed', type=int, help='Seed of the random data, a random one is used if omitted')
+@click.option('--workers', default=1, show_default=True, help='Amount of worker processes')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows per INSERT batch on databases other than PostgreSQL and SQLite')
+@with_appcontext
+def generate_command(students, groups, courses, seed, workers, batch_size):
+    """Fill the database with synthetic groups, courses, students and attendings"""
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    click.echo(f'Generating data with seed {seed}')
+    stats = create_all_data(students, groups, courses, seed, workers, batch_size)
+    for table, (rows, seconds) in stats.items():
+        click.echo(f'{table}: {rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+import bisect
+
+from flask_restful import abort
+from sqlalchemy import func, select
+
+from dialects import insert_returning_ids, update_id_ranges
+from models import GroupModel, StudentModel
+
+GROUP_NAMES_COUNT = 26 * 26 * 100
+
+
+def group_name(number):
+    """Name like 'AB-07' for a number below GROUP_NAMES_COUNT"""
+    letters, digits = divmod(number, 100)
+    return f'{chr(65 + letters // 26)}{chr(65 + letters % 26)}-{digits:02d}'
+
+
+def free_group_names(existing_names, count):
+    """First 'count' unused group names in number order, or None when there are not enough of them"""
+    names = []
+    for number in range(GROUP_NAMES_COUNT):
+        if len(names) == count:
+            break
+        name = group_name(number)
+        if name not in existing_names:
+            names.append(name)
+    return names if len(names) == count else None
+
+
+def balanced_additions(sizes, amount, max_size):
+    """Amounts to add to groups of 'sizes' so that the smallest ones grow first and none exceeds 'max_size'.
+    The amounts may be less than 'amount' in total when the groups are full"""
+    def added(level):
+        return sum(max(0, level - size) for size in sizes)
+
+    # Highest level all groups below it can be raised to, found by bisection
+    low, high = 0, max_size
+    while low < high:
+        level = (low + high + 1) // 2
+        if added(level) <= amount:
+            low = level
+        else:
+            high = level - 1
+    additions = [max(0, low - size) for size in sizes]
+    # The rest raises the groups at the level by one, in order, while it stays under the maximum
+    rest = amount - sum(additions)
+    if low < max_size:
+        for position, size in enumerate(sizes):
+            if rest == 0:
+                break
+            if size <= low:
+                additions[position] += 1
+                rest -= 1
+    return additions
+
+
+class IdRuns:
+    """Sorted IDs kept as runs of consecutive values, (first_id, last_id) each"""
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.starts = []
+        self.count = 0
+        for first_id, last_id in runs:
+            self.starts.append(self.count)
+            self.count += last_id - first_id + 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        run = bisect.bisect_right(self.starts, position) - 1
+        return self.runs[run][0] + position - self.starts[run]
+
+
+def ungrouped_runs(session):
+    """IDs of students without a group as IdRuns. Students are mostly added in bulk, so there are few runs
+    and the IDs themselves don't have to be sent"""
+    # IDs of a run have the same difference to their position
+    numbered = (select(StudentModel.id,
+                       (StudentModel.id - func.row_number().over(order_by=StudentModel.id)).label('run'))
+                .where(StudentModel.group_id.is_(None))
+                .subquery())
+    return IdRuns(session.execute(select(func.min(numbered.c.id), func.max(numbered.c.id))
+                                  .group_by(numbered.c.run)
+                                  .order_by(func.min(numbered.c.id))).all())
+
+
+def plan_assignment(groups, student_ids, max_size, existing_names):
+    """Balanced assignment of 'student_ids', a sorted sequence, to 'groups' given as (id, name, students_count) rows,
+    with new groups for the students that do not fit. Each group takes the next run of students,
+    so the students of a group are the ungrouped ones between its first and last ID"""
+    students_count = len(student_ids)
+    spare = sum(max(0, max_size - count) for _, _, count in groups)
+    new_count = -(-max(0, students_count - spare) // max_size)
+    new_names = free_group_names(existing_names, new_count)
+    if new_names is None:
+        abort(409, message=f'{new_count} new groups are needed, but there are not enough free group names')
+    rows = [(group_id, name, count) for group_id, name, count in groups] + [(None, name, 0) for name in new_names]
+    plan = []
+    position = 0
+    for (group_id, name, count), amount in zip(rows, balanced_additions([count for _, _, count in rows],
+                                                                        students_count, max_size)):
+        if amount == 0:
+            continue
+        plan.append({'group_id': group_id, 'name': name, 'new': group_id is None, 'students_before': count,
+                     'students_after': count + amount, 'assigned': amount,
+                     'first_student_id': student_ids[position], 'last_student_id': student_ids[position + amount - 1]})
+        position += amount
+    return plan
+
+
+def auto_assign(session, bind, max_size, dry_run, batch_size):
+    """Assign every student without a group to groups of at most 'max_size' students, creating groups as needed.
+    Return the plan, applied unless 'dry_run', in one UPDATE per batch of groups"""
+    # Groups are locked in ID order like in move_students(), so concurrent moves can't push them over the maximum
+    groups_query = select(GroupModel.id, GroupModel.name, GroupModel.students_count).order_by(GroupModel.id)
+    groups = session.execute(groups_query if dry_run else groups_query.with_for_update()).all()
+    plan = plan_assignment(groups, ungrouped_runs(session), max_size, {name for _, name, _ in groups})
+    if dry_run or not plan:
+        return plan
+
+    new_entries = [entry for entry in plan if entry['new']]
+    new_ids = insert_returning_ids(session, bind, GroupModel.__table__,
+                                   [{'name': entry['name']} for entry in new_entries], batch_size)
+    for entry, group_id in zip(new_entries, new_ids):
+        entry['group_id'] = group_id
+    # A student grouped meanwhile keeps the group
+    ranges = [(entry['group_id'], entry['first_student_id'], entry['last_student_id']) for entry in plan]
+    update_id_ranges(session, bind, StudentModel.__table__, 'group_id', ranges, batch_size)
+    return plan
@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RequestStatements:
+    """Statements executed while handling one request"""
+    __slots__ = ('count', 'seconds', 'slowest', 'slowest_seconds', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = None
+        self.slowest_seconds = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement] += 1
+        if seconds > self.slowest_seconds:
+            self.slowest, self.slowest_seconds = statement, seconds
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class EndpointMetrics:
+    __slots__ = ('latency', 'db_time', 'statements', 'n_plus_one')
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.db_time = Histogram(buckets)
+        self.statements = 0
+        self.n_plus_one = 0
+
+
+class InstrumentationState:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        # Functions returning more lines for /metrics, see Instrumentation.add_metrics
+        self.collectors = []
+
+
+class Instrumentation:
+    """Statement count, database time and slowest statement of every request, reported in the Server-Timing
+    header and in Prometheus histograms per endpoint served at /metrics"""
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        app.config.setdefault('SERVER_TIMING', True)
+        app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10)
+        app.config.setdefault('SLOW_STATEMENT_SECONDS', 0.5)
+        app.config.setdefault('METRICS_URL', '/metrics')
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+        app.extensions['instrumentation'] = InstrumentationState(LATENCY_BUCKETS)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        if app.config['METRICS_URL']:
+            app.add_url_rule(app.config['METRICS_URL'], 'metrics', self.metrics_view)
+
+    @property
+    def state(self):
+        return current_app.extensions['instrumentation']
+
+    @staticmethod
+    def add_metrics(app, collector):
+        """Serve the lines collector() returns at /metrics as well, when the app is instrumented"""
+        state = app.extensions.get('instrumentation')
+        if state is not None:
+            state.collectors.append(collector)
+
+    @staticmethod
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.request_statements = RequestStatements()
+
+    def finish_request(self, response):
+        statements = g.pop('request_statements', None)
+        if statements is None:
+            return response
+        seconds = time.perf_counter() - g.pop('request_started')
+        config = current_app.config
+        endpoint = request.endpoint or 'unmatched'
+        shape, repeats = statements.shapes.most_common(1)[0] if statements.shapes else (None, 0)
+        n_plus_one = repeats > config['N_PLUS_ONE_THRESHOLD']
+        if n_plus_one:
+            current_app.logger.warning('%s %s repeated a statement %d times: %s',
+                                       request.method, request.path, repeats, shape)
+        if statements.slowest_seconds > config['SLOW_STATEMENT_SECONDS']:
+            current_app.logger.warning('%s %s ran a statement for %.3fs: %s',
+                                       request.method, request.path, statements.slowest_seconds, statements.slowest)
+        if config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f'db;dur={statements.seconds * 1000:.2f};desc="{statements.count} statements", '
+                f'db-slowest;dur={statements.slowest_seconds * 1000:.2f}, '
+                f'app;dur={seconds * 1000:.2f}')
+
+        state = self.state
+        key = (endpoint, request.method)
+        with state.lock:
+            metrics = state.endpoints.get(key)
+            if metrics is None:
+                metrics = state.endpoints[key] = EndpointMetrics(state.buckets)
+            metrics.latency.observe(seconds)
+            metrics.db_time.observe(statements.seconds)
+            metrics.statements += statements.count
+            metrics.n_plus_one += n_plus_one
+        return response
+
+    def metrics_view(self):
+        state = self.state
+        lines = ['# HELP http_request_duration_seconds Time spent handling the request.',
+                 '# TYPE http_request_duration_seconds histogram']
+        with state.lock:
+            endpoints = sorted(state.endpoints.items())
+            for (endpoint, method), metrics in endpoints:
+                lines.extend(metrics.latency.samples('http_request_duration_seconds',
+                                                     f'endpoint="{endpoint}",method="{method}"'))
+            lines += ['# HELP http_request_db_seconds Time spent in database statements per request.',
+                      '# TYPE http_request_db_seconds histogram']
+            for (endpoint, method), metrics in endpoints:
+                lines.extend(metrics.db_time.samples('http_request_db_seconds',
+                                                     f'endpoint="{endpoint}",method="{method}"'))
+            lines += ['# HELP http_request_statements_total Database statements executed by requests.',
+                      '# TYPE http_request_statements_total counter']
+            lines += [f'http_request_statements_total{{endpoint="{endpoint}",method="{method}"}} {metrics.statements}'
+                      for (endpoint, method), metrics in endpoints]
+            lines += ['# HELP http_request_n_plus_one_total Requests repeating a statement over the threshold.',
+                      '# TYPE http_request_n_plus_one_total counter']
+            lines += [f'http_request_n_plus_one_total{{endpoint="{endpoint}",method="{method}"}} {metrics.n_plus_one}'
+                      for (endpoint, method), metrics in endpoints]
+        for collector in state.collectors:
+            lines += collector()
+        return Response('\n'.join(lines) + '\n', content_type=METRICS_CONTENT_TYPE)
+
+
+instrumentation = Instrumentation()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def statement_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def statement_finished(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['statement_started']
+    # Statements of streamed responses run after the request is finished and are not counted
+    statements = g.get('request_statements') if has_app_context() else None
+    if statements is not None:
+        statements.add(statement, seconds)
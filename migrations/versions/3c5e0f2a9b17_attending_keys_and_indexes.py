@@ -0,0 +1,60 @@
+"""attending keys and indexes
+
+Revision ID: 3c5e0f2a9b17
+Revises: 8df1e1f90fb3
+Create Date: 2026-10-18 15:40:12.481930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e0f2a9b17'
+down_revision = '8df1e1f90fb3'
+branch_labels = None
+depends_on = None
+
+# Unnamed constraints reflected by batch mode on SQLite get the same names PostgreSQL gives them
+naming_convention = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def upgrade():
+    # The primary key can't be built over incomplete or repeated pairs
+    op.execute('DELETE FROM attending WHERE student_id IS NULL OR course_id IS NULL')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DELETE FROM attending a USING attending b '
+                   'WHERE a.ctid > b.ctid AND a.student_id = b.student_id AND a.course_id = b.course_id')
+    else:
+        op.execute('DELETE FROM attending WHERE rowid NOT IN '
+                   '(SELECT min(rowid) FROM attending GROUP BY student_id, course_id)')
+
+    with op.batch_alter_table('attending', naming_convention=naming_convention) as batch_op:
+        batch_op.alter_column('student_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('course_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_constraint('attending_student_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('attending_course_id_fkey', type_='foreignkey')
+        batch_op.create_primary_key('attending_pkey', ['student_id', 'course_id'])
+        batch_op.create_foreign_key('attending_student_id_fkey', 'students', ['student_id'], ['id'],
+                                    ondelete='CASCADE')
+        batch_op.create_foreign_key('attending_course_id_fkey', 'courses', ['course_id'], ['id'],
+                                    ondelete='CASCADE')
+        batch_op.create_index('ix_attending_course_id_student_id', ['course_id', 'student_id'])
+
+    with op.batch_alter_table('students') as batch_op:
+        batch_op.create_index('ix_students_group_id', ['group_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('students') as batch_op:
+        batch_op.drop_index('ix_students_group_id')
+
+    with op.batch_alter_table('attending', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_attending_course_id_student_id')
+        batch_op.drop_constraint('attending_course_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('attending_student_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('attending_pkey', type_='primary')
+        batch_op.create_foreign_key('attending_student_id_fkey', 'students', ['student_id'], ['id'])
+        batch_op.create_foreign_key('attending_course_id_fkey', 'courses', ['course_id'], ['id'])
+        batch_op.alter_column('course_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('student_id', existing_type=sa.Integer(), nullable=True)
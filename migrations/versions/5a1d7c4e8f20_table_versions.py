@@ -0,0 +1,30 @@
+"""table versions
+
+Revision ID: 5a1d7c4e8f20
+Revises: 3c5e0f2a9b17
+Create Date: 2026-10-18 16:05:47.112804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1d7c4e8f20'
+down_revision = '3c5e0f2a9b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(table_versions, [{'table_name': table_name, 'version': 0}
+                                    for table_name in ('groups', 'students', 'courses', 'attending')])
+
+
+def downgrade():
+    op.drop_table('table_versions')
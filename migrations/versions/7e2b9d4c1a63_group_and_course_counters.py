@@ -0,0 +1,94 @@
+"""group and course counters
+
+Revision ID: 7e2b9d4c1a63
+Revises: 5a1d7c4e8f20
+Create Date: 2026-10-18 16:48:03.590217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e2b9d4c1a63'
+down_revision = '5a1d7c4e8f20'
+branch_labels = None
+depends_on = None
+
+COUNTERS = [
+    ('students', 'group_id', 'groups', 'students_count'),
+    ('attending', 'course_id', 'courses', 'enrolled_count'),
+]
+
+
+def counter_triggers(source, key, target, counter):
+    """DDL of triggers that keep 'target.counter' equal to the amount of 'source' rows referencing it by 'key'.
+    PostgreSQL triggers run once per statement over its transition tables, SQLite ones run per row"""
+    changes = {
+        'INSERT': f'SELECT {key}, 1 AS amount FROM new_rows',
+        'DELETE': f'SELECT {key}, -1 AS amount FROM old_rows',
+        'UPDATE': f'SELECT {key}, 1 AS amount FROM new_rows UNION ALL SELECT {key}, -1 AS amount FROM old_rows',
+    }
+    function_body = '\n'.join(
+        f"""    IF TG_OP = '{operation}' THEN
+        UPDATE {target} SET {counter} = {target}.{counter} + delta.amount
+        FROM (SELECT {key}, sum(amount) AS amount FROM ({rows}) AS changes
+              WHERE {key} IS NOT NULL GROUP BY {key} HAVING sum(amount) <> 0) AS delta
+        WHERE {target}.id = delta.{key};
+    END IF;""" for operation, rows in changes.items())
+    transition_tables = {
+        'INSERT': 'NEW TABLE AS new_rows',
+        'DELETE': 'OLD TABLE AS old_rows',
+        'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    }
+    postgresql = [f"""CREATE OR REPLACE FUNCTION {source}_{counter}() RETURNS trigger AS $$
+BEGIN
+{function_body}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""]
+    postgresql += [f'CREATE TRIGGER {source}_{counter}_{operation.lower()} AFTER {operation} ON {source} '
+                   f'REFERENCING {tables} FOR EACH STATEMENT EXECUTE PROCEDURE {source}_{counter}()'
+                   for operation, tables in transition_tables.items()]
+    sqlite = [
+        f'CREATE TRIGGER {source}_{counter}_insert AFTER INSERT ON {source} WHEN NEW.{key} IS NOT NULL '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} + 1 WHERE id = NEW.{key}; END',
+        f'CREATE TRIGGER {source}_{counter}_delete AFTER DELETE ON {source} WHEN OLD.{key} IS NOT NULL '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} - 1 WHERE id = OLD.{key}; END',
+        f'CREATE TRIGGER {source}_{counter}_update AFTER UPDATE OF {key} ON {source} '
+        f'WHEN OLD.{key} IS NOT NEW.{key} '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} - 1 WHERE id = OLD.{key}; '
+        f'UPDATE {target} SET {counter} = {counter} + 1 WHERE id = NEW.{key}; END',
+    ]
+    return {'postgresql': postgresql, 'sqlite': sqlite}
+
+
+def upgrade():
+    with op.batch_alter_table('groups') as batch_op:
+        batch_op.add_column(sa.Column('students_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index('ix_groups_students_count', ['students_count'])
+    with op.batch_alter_table('courses') as batch_op:
+        batch_op.add_column(sa.Column('enrolled_count', sa.Integer(), server_default='0', nullable=False))
+
+    dialect = op.get_bind().dialect.name
+    for source, key, target, counter in COUNTERS:
+        op.execute(f'UPDATE {target} SET {counter} = '
+                   f'(SELECT count(*) FROM {source} WHERE {source}.{key} = {target}.id)')
+        for statement in counter_triggers(source, key, target, counter).get(dialect, []):
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for source, key, target, counter in COUNTERS:
+        for operation in ('insert', 'delete', 'update'):
+            op.execute(f'DROP TRIGGER IF EXISTS {source}_{counter}_{operation}'
+                       + (f' ON {source}' if dialect == 'postgresql' else ''))
+        if dialect == 'postgresql':
+            op.execute(f'DROP FUNCTION IF EXISTS {source}_{counter}()')
+
+    with op.batch_alter_table('courses') as batch_op:
+        batch_op.drop_column('enrolled_count')
+    with op.batch_alter_table('groups') as batch_op:
+        batch_op.drop_index('ix_groups_students_count')
+        batch_op.drop_column('students_count')
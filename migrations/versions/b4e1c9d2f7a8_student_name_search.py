@@ -0,0 +1,42 @@
+"""student name search
+
+Revision ID: b4e1c9d2f7a8
+Revises: 7e2b9d4c1a63
+Create Date: 2026-10-18 19:12:36.804417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e1c9d2f7a8'
+down_revision = '7e2b9d4c1a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite searches names in memory, see search.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE INDEX ix_students_first_name_lower ON students (lower(first_name) COLLATE "C", id)')
+    op.execute('CREATE INDEX ix_students_last_name_lower ON students (lower(last_name) COLLATE "C", id)')
+    # Substring matches use trigram indexes where the server has the pg_trgm extension
+    op.execute("""DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX ix_students_first_name_trgm ON students USING gin (lower(first_name) gin_trgm_ops);
+        CREATE INDEX ix_students_last_name_trgm ON students USING gin (lower(last_name) gin_trgm_ops);
+    END IF;
+END
+$$""")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for index in ('ix_students_last_name_trgm', 'ix_students_first_name_trgm',
+                  'ix_students_last_name_lower', 'ix_students_first_name_lower'):
+        op.execute(f'DROP INDEX IF EXISTS {index}')
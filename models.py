@@ -1,30 +1,96 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import DDL, event, orm
+from sqlalchemy.pool import QueuePool
 from typing import Callable
 
+from dialects import listen_sqlite_pragmas, sqlite_pragmas
+
+# Key of the read replica in SQLALCHEMY_BINDS
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    """Session sending statements to the read replica while a read-only handler runs, see replica.read_only"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if has_app_context() and g.get('read_replica'):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
 
 class MySQLAlchemy(SQLAlchemy):
     Column: Callable
     String: Callable
     Integer: Callable
+    BigInteger: Callable
     Text: Callable
     Table: Callable
     ForeignKey: Callable
+    Index: Callable
     relationship: Callable
     backref: Callable
 
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """Add the pool settings and the statement timeout of the config to the engine options,
+        and the pragmas of SQLite, see create_engine()"""
+        config = app.config
+        sqlite = sa_url.get_backend_name() == 'sqlite'
+        # An in-memory SQLite database keeps its one connection, see SQLAlchemy.apply_driver_hacks. Connections to
+        # files are pooled as well, so their page cache and memory map outlive the request
+        if not sqlite or sa_url.database not in (None, '', ':memory:'):
+            options.setdefault('pool_size', config.get('DATABASE_POOL_SIZE', 5))
+            options.setdefault('max_overflow', config.get('DATABASE_MAX_OVERFLOW', 10))
+        if sqlite:
+            options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+            options['sqlite_pragmas'] = sqlite_pragmas(config)
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sqlite and 'pool_size' in options:
+            options['poolclass'] = QueuePool
+        options.setdefault('pool_pre_ping', config.get('DATABASE_POOL_PRE_PING', False))
+        options.setdefault('pool_recycle', config.get('DATABASE_POOL_RECYCLE', -1))
+        timeout = config.get('DATABASE_STATEMENT_TIMEOUT_MS')
+        if timeout and sa_url.get_backend_name() == 'postgresql':
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = f"{connect_args.get('options', '')} -c statement_timeout={timeout}".strip()
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            listen_sqlite_pragmas(engine, pragmas)
+        return engine
+
 
 db = MySQLAlchemy()
 
 
 attending = db.Table('attending',
-                     db.Column('student_id', db.Integer, db.ForeignKey('students.id')),
-                     db.Column('course_id', db.Integer, db.ForeignKey('courses.id')))  # lazy param
+                     db.Column('student_id', db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'),
+                               primary_key=True),
+                     db.Column('course_id', db.Integer, db.ForeignKey('courses.id', ondelete='CASCADE'),
+                               primary_key=True),
+                     db.Index('ix_attending_course_id_student_id', 'course_id', 'student_id'))
+
+# Change counters of the tables above, used to invalidate cached results when CACHE_BACKEND is 'database'
+table_versions = db.Table('table_versions',
+                          db.Column('table_name', db.String(50), primary_key=True),
+                          db.Column('version', db.BigInteger, nullable=False, default=0))
 
 
 class GroupModel(db.Model):
     __tablename__ = "groups"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(5), unique=True)
+    students_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
     students = db.relationship('StudentModel', backref='group', lazy=True)
 
     def __init__(self, name):
@@ -37,10 +103,11 @@ class GroupModel(db.Model):
 class StudentModel(db.Model):
     __tablename__ = "students"
     id = db.Column(db.Integer, primary_key=True)
-    group_id = db.Column(db.Integer, db.ForeignKey('groups.id'), nullable=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('groups.id'), nullable=True, index=True)
     first_name = db.Column(db.String())
     last_name = db.Column(db.String())
-    courses = db.relationship('CourseModel', secondary=attending, backref=db.backref('students_on_course', lazy='dynamic'))
+    courses = db.relationship('CourseModel', secondary=attending, passive_deletes=True,
+                              backref=db.backref('students_on_course', lazy='dynamic'))
 
     def __init__(self, group_id, first_name, last_name):
         self.group_id = group_id
@@ -56,6 +123,7 @@ class CourseModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_name = db.Column(db.String(), unique=True)
     description = db.Column(db.Text())
+    enrolled_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __init__(self, course_name, description):
         self.course_name = course_name
@@ -63,3 +131,78 @@ class CourseModel(db.Model):
 
     def __repr__(self):
         return f"<Course {self.course_name}>"
+
+
+def counter_triggers(source, key, target, counter):
+    """DDL of triggers that keep 'target.counter' equal to the amount of 'source' rows referencing it by 'key'.
+    PostgreSQL triggers run once per statement over its transition tables, SQLite ones run per row"""
+    changes = {
+        'INSERT': f'SELECT {key}, 1 AS amount FROM new_rows',
+        'DELETE': f'SELECT {key}, -1 AS amount FROM old_rows',
+        'UPDATE': f'SELECT {key}, 1 AS amount FROM new_rows UNION ALL SELECT {key}, -1 AS amount FROM old_rows',
+    }
+    function_body = '\n'.join(
+        f"""    IF TG_OP = '{operation}' THEN
+        UPDATE {target} SET {counter} = {target}.{counter} + delta.amount
+        FROM (SELECT {key}, sum(amount) AS amount FROM ({rows}) AS changes
+              WHERE {key} IS NOT NULL GROUP BY {key} HAVING sum(amount) <> 0) AS delta
+        WHERE {target}.id = delta.{key};
+    END IF;""" for operation, rows in changes.items())
+    transition_tables = {
+        'INSERT': 'NEW TABLE AS new_rows',
+        'DELETE': 'OLD TABLE AS old_rows',
+        'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    }
+    postgresql = [f"""CREATE OR REPLACE FUNCTION {source}_{counter}() RETURNS trigger AS $$
+BEGIN
+{function_body}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""]
+    postgresql += [f'CREATE TRIGGER {source}_{counter}_{operation.lower()} AFTER {operation} ON {source} '
+                   f'REFERENCING {tables} FOR EACH STATEMENT EXECUTE PROCEDURE {source}_{counter}()'
+                   for operation, tables in transition_tables.items()]
+    sqlite = [
+        f'CREATE TRIGGER {source}_{counter}_insert AFTER INSERT ON {source} WHEN NEW.{key} IS NOT NULL '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} + 1 WHERE id = NEW.{key}; END',
+        f'CREATE TRIGGER {source}_{counter}_delete AFTER DELETE ON {source} WHEN OLD.{key} IS NOT NULL '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} - 1 WHERE id = OLD.{key}; END',
+        f'CREATE TRIGGER {source}_{counter}_update AFTER UPDATE OF {key} ON {source} '
+        f'WHEN OLD.{key} IS NOT NEW.{key} '
+        f'BEGIN UPDATE {target} SET {counter} = {counter} - 1 WHERE id = OLD.{key}; '
+        f'UPDATE {target} SET {counter} = {counter} + 1 WHERE id = NEW.{key}; END',
+    ]
+    return {'postgresql': postgresql, 'sqlite': sqlite}
+
+
+COUNTER_TRIGGERS = {
+    StudentModel.__table__: counter_triggers('students', 'group_id', 'groups', 'students_count'),
+    attending: counter_triggers('attending', 'course_id', 'courses', 'enrolled_count'),
+}
+
+for counted_table, triggers in COUNTER_TRIGGERS.items():
+    for dialect, statements in triggers.items():
+        for statement in statements:
+            event.listen(counted_table, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
+# Indexes of the student search, see search.py. Prefix matches are read in the order of the first two,
+# the trigram indexes serve substring matches where the pg_trgm extension is available
+STUDENT_NAME_INDEXES = {
+    'postgresql': [
+        'CREATE INDEX ix_students_first_name_lower ON students (lower(first_name) COLLATE "C", id)',
+        'CREATE INDEX ix_students_last_name_lower ON students (lower(last_name) COLLATE "C", id)',
+        """DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX ix_students_first_name_trgm ON students USING gin (lower(first_name) gin_trgm_ops);
+        CREATE INDEX ix_students_last_name_trgm ON students USING gin (lower(last_name) gin_trgm_ops);
+    END IF;
+END
+$$""",
+    ],
+}
+
+for dialect, statements in STUDENT_NAME_INDEXES.items():
+    for statement in statements:
+        event.listen(StudentModel.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
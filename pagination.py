@@ -0,0 +1,28 @@
+from flask import current_app, request
+
+
+def page_args(args=None, config=None):
+    """Read 'after_id' and 'limit' from the query string. The limit is clamped to MAX_PAGE_SIZE"""
+    args = request.args if args is None else args
+    config = current_app.config if config is None else config
+    after_id = args.get('after_id', type=int, default=0)
+    limit = args.get('limit', type=int, default=config['PAGE_SIZE'])
+    return after_id, max(1, min(limit, config['MAX_PAGE_SIZE']))
+
+
+def keyset_query(query, key, after_id, limit):
+    """Query or select() of the rows following 'after_id' in 'key' order, with one row of the next page"""
+    return query.filter(key > after_id).order_by(key).limit(limit + 1)
+
+
+def split_page(rows, limit):
+    """Return the rows of the page and the cursor of the next page. Rows must expose the key value as 'id'"""
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def keyset_page(query, key, after_id, limit):
+    """Return rows of the query that follow 'after_id' in 'key' order and the cursor of the next page.
+    Rows must expose the key value as 'id'"""
+    return split_page(keyset_query(query, key, after_id, limit).all(), limit)
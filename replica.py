@@ -0,0 +1,75 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g
+from sqlalchemy.exc import OperationalError
+
+from models import db, REPLICA_BIND
+
+
+class ReplicaState:
+    def __init__(self):
+        self.down_until = 0.0
+        self.fallbacks = 0
+
+
+class ReadReplica:
+    """Optional replica of the database that read-only handlers query instead of the primary.
+    When the replica fails, the handler is repeated on the primary and the replica is skipped for a while"""
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_URI', None)
+        app.config.setdefault('REPLICA_RETRY_SECONDS', 30)
+        if app.config['REPLICA_URI']:
+            binds = app.config.setdefault('SQLALCHEMY_BINDS', {}) or {}
+            app.config['SQLALCHEMY_BINDS'] = dict(binds, **{REPLICA_BIND: app.config['REPLICA_URI']})
+        app.extensions['read_replica'] = ReplicaState()
+
+    @property
+    def state(self):
+        return current_app.extensions['read_replica']
+
+    def available(self):
+        return bool(current_app.config['REPLICA_URI']) and time.monotonic() >= self.state.down_until
+
+    def mark_down(self):
+        state = self.state
+        state.down_until = time.monotonic() + current_app.config['REPLICA_RETRY_SECONDS']
+        state.fallbacks += 1
+
+
+replica = ReadReplica()
+
+
+def read_only(view):
+    """Run the handler against the read replica if one is configured and up"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not replica.available():
+            return view(*args, **kwargs)
+        try:
+            with routed(True):
+                return view(*args, **kwargs)
+        except OperationalError as error:
+            current_app.logger.warning('Read replica failed, using the primary: %s', error.orig)
+            # Objects loaded from the replica must not be reused, the transaction on the primary stays intact
+            db.session.expunge_all()
+            replica.mark_down()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def routed(to_replica):
+    previous = g.get('read_replica', False)
+    g.read_replica = to_replica
+    try:
+        yield
+    finally:
+        g.read_replica = previous
+
+
+def primary():
+    """Send statements to the primary within a read-only handler"""
+    return routed(False)
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from cache import cache, CHANGED_TABLES
+from models import db
+
+ROSTER_TABLES = ('attending', 'students', 'groups', 'courses')
+# session.info keys with the changes recorded by the write paths, and the ones of the committing transaction
+ROSTER_CHANGES = 'roster_changes'
+COMMITTING_CHANGES = 'roster_committing'
+
+
+class RosterState:
+    def __init__(self):
+        self.index = None
+        self.lock = threading.RLock()
+        self.builds = 0
+        self.built_at = 0.0
+
+
+class Roster:
+    """In-memory RosterIndex of courses and groups, built from the database on first use, or when the app is created
+    with ROSTER_PRELOAD. Write paths record their changes with enrolled(), students_added() and the like, and the
+    index applies them after the commit. A commit changing the tables without recording its changes drops the index.
+    With the shared 'database' cache backend the writes of other processes can't be applied, so the index is rebuilt
+    whenever the versions of the tables changed. The 'local' backend does not see those writes at all, the index is
+    rebuilt once it is ROSTER_LOCAL_MAX_AGE seconds old instead"""
+
+    def init_app(self, app):
+        app.config.setdefault('ROSTER_PRELOAD', False)
+        app.config.setdefault('ROSTER_LOCAL_MAX_AGE', 30)
+        app.extensions['roster_index'] = RosterState()
+        if app.config['ROSTER_PRELOAD']:
+            threading.Thread(target=self.preload, args=(app,), name='roster-preload', daemon=True).start()
+
+    @property
+    def state(self):
+        return current_app.extensions['roster_index']
+
+    def preload(self, app):
+        with app.app_context():
+            try:
+                self.index()
+            except Exception:
+                app.logger.exception('Building the roster index failed')
+            finally:
+                db.session.remove()
+
+    def index(self):
+        """Index of the committed data"""
+        state = self.state
+        versions = cache.state.versions
+        with state.lock:
+            index = state.index
+            if index is None or (index.versions != versions.get(ROSTER_TABLES) if versions.shared else
+                                 time.monotonic() - state.built_at > current_app.config['ROSTER_LOCAL_MAX_AGE']):
+                state.index = index = self.build(versions.get(ROSTER_TABLES))
+            return index
+
+    def build(self, versions):
+        # NumPy is imported with the first index only
+        from bitmaps import build_index
+        # Writes committed while building are counted in the age
+        started = time.monotonic()
+        # One snapshot of the three tables, apart from the transaction of the request
+        with db.engine.connect() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection = connection.execution_options(isolation_level='REPEATABLE READ')
+            with connection.begin():
+                index = build_index(connection, versions)
+        self.state.builds += 1
+        self.state.built_at = started
+        return index
+
+    def record(self, method, *args):
+        db.session.info.setdefault(ROSTER_CHANGES, []).append((method, args))
+
+    def enrolled(self, pairs):
+        self.record('enroll', list(pairs))
+
+    def unenrolled(self, pairs):
+        self.record('unenroll', list(pairs))
+
+    def students_added(self, rows):
+        self.record('add_students', list(rows))
+
+    def students_deleted(self, student_ids):
+        self.record('delete_students', list(student_ids))
+
+    def students_moved(self, student_ids, group_id):
+        self.record('move_students', list(student_ids), group_id)
+
+    def apply(self, changes):
+        """Apply the changes of a committed transaction, or drop the index when they were not recorded"""
+        state = self.state
+        with state.lock:
+            if state.index is None:
+                return
+            if changes is None or cache.state.versions.shared:
+                state.index = None
+                return
+            for method, args in changes:
+                getattr(state.index, method)(*args)
+
+    def stats(self):
+        state = self.state
+        index = state.index
+        return {'built': index is not None, 'builds': state.builds, 'memory': index.memory() if index else None}
+
+
+roster = Roster()
+
+
+@event.listens_for(Session, 'before_commit')
+def collect_changes(session):
+    changes = session.info.pop(ROSTER_CHANGES, None)
+    changed = session.info.get(CHANGED_TABLES)
+    # None drops the index, the transaction changed it in ways it does not know
+    if changes or (changed and set(changed[1]) & set(ROSTER_TABLES)):
+        session.info[COMMITTING_CHANGES] = changes
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_changes(session):
+    if COMMITTING_CHANGES not in session.info:
+        return
+    changes = session.info.pop(COMMITTING_CHANGES)
+    if has_app_context() and 'roster_index' in current_app.extensions:
+        roster.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop(ROSTER_CHANGES, None)
+    session.info.pop(COMMITTING_CHANGES, None)
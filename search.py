@@ -0,0 +1,130 @@
+import bisect
+import heapq
+
+from flask import current_app
+from sqlalchemy import func, or_, select, union_all
+
+from cache import cache
+from models import db, StudentModel
+
+NAME_COLUMNS = (StudentModel.first_name, StudentModel.last_name)
+
+# Escape character of the LIKE patterns, SQLite has no default one
+ESCAPE = '/'
+
+
+def like_escape(text):
+    return text.replace(ESCAPE, ESCAPE * 2).replace('%', ESCAPE + '%').replace('_', ESCAPE + '_')
+
+
+def name_key(column, dialect_name):
+    """Lowercase name compared byte by byte, so it can use the prefix indexes of PostgreSQL"""
+    key = func.lower(column)
+    return key.collate('C') if dialect_name == 'postgresql' else key
+
+
+def search_students(conn, dialect_name, text, columns, limit, min_substring):
+    """Rows of 'columns' of students whose first or last name starts with or contains 'text', case-insensitive.
+    Prefix matches come first, ordered by the matched name as the name indexes are. Students containing 'text'
+    are searched only when there are less than 'limit' prefix matches, ordered by ID"""
+    text = text.lower()
+    prefix = like_escape(text) + '%'
+    keys = [name_key(column, dialect_name) for column in NAME_COLUMNS]
+    # SQLite does not take ORDER BY and LIMIT on the members of a UNION, only on subqueries
+    parts = [select(select(*columns, key.label('matched'))
+                    .where(key.like(prefix, escape=ESCAPE))
+                    .order_by(key, StudentModel.id)
+                    .limit(limit)
+                    .subquery())
+             for key in keys]
+    rows = first_students(conn.execute(union_all(*parts)).all(), limit)
+    if len(rows) < limit and len(text) >= min_substring:
+        # Less than 'limit' prefix matches means all of them were found above
+        contains = '%' + like_escape(text) + '%'
+        rows += conn.execute(select(*columns)
+                             .where(or_(*(key.like(contains, escape=ESCAPE) for key in keys)),
+                                    *(or_(key.is_(None), ~key.like(prefix, escape=ESCAPE)) for key in keys))
+                             .order_by(StudentModel.id)
+                             .limit(limit - len(rows))).all()
+    return rows
+
+
+def first_students(rows, limit):
+    """Rows of the first 'limit' students by the matched name, each student once"""
+    seen = set()
+    result = []
+    for row in sorted(rows, key=lambda row: (row.matched, row.id)):
+        if row.id not in seen:
+            seen.add(row.id)
+            result.append(row)
+    return result[:limit]
+
+
+class NameIndex:
+    """Distinct lowercase names of one column with IDs of the students having them, sorted for prefix search.
+    Used where the database has no suitable index"""
+
+    def __init__(self, rows):
+        self.ids = {}
+        for student_id, name in rows:
+            self.ids.setdefault((name or '').lower(), []).append(student_id)
+        for ids in self.ids.values():
+            ids.sort()
+        self.names = sorted(self.ids)
+
+    def prefixed(self, text, limit):
+        """(name, id) of up to 'limit' students with a name starting with 'text', in name and ID order"""
+        matches = []
+        for name in self.names[bisect.bisect_left(self.names, text):]:
+            if not name.startswith(text):
+                break
+            matches.extend((name, student_id) for student_id in self.ids[name][:limit - len(matches)])
+            if len(matches) == limit:
+                break
+        return matches
+
+    def containing(self, text):
+        """IDs of students with a name containing 'text'"""
+        return {student_id for name in self.names if text in name for student_id in self.ids[name]}
+
+
+class StudentNames:
+    """In-memory name indexes of all students"""
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.first_names = NameIndex((student_id, first_name) for student_id, first_name, _ in rows)
+        self.last_names = NameIndex((student_id, last_name) for student_id, _, last_name in rows)
+
+    def search(self, text, limit, min_substring):
+        """IDs of matching students, in the order search_students() returns them"""
+        text = text.lower()
+        indexes = (self.first_names, self.last_names)
+        matches = sorted(match for index in indexes for match in index.prefixed(text, limit))
+        student_ids = list(dict.fromkeys(student_id for _, student_id in matches))[:limit]
+        if len(student_ids) < limit and len(text) >= min_substring:
+            prefixed = set(student_ids)
+            contained = set().union(*(index.containing(text) for index in indexes)) - prefixed
+            student_ids += heapq.nsmallest(limit - len(student_ids), contained)
+        return student_ids
+
+
+def load_names():
+    return StudentNames(db.session.execute(select(StudentModel.id, StudentModel.first_name,
+                                                  StudentModel.last_name)))
+
+
+def find_students(text, limit, columns):
+    """Dictionaries of 'columns' of students found by search_students(). Without the name indexes of PostgreSQL
+    the names are searched in memory, the index is rebuilt after students change. It is kept in the aggregate
+    cache, so only with versions shared by every process; the 'local' backend misses students added elsewhere"""
+    config = current_app.config
+    dialect_name = db.session.get_bind().dialect.name
+    keys = [column.name for column in columns]
+    if dialect_name == 'postgresql' or not (config['CACHE_ENABLED'] and cache.state.versions.shared):
+        rows = search_students(db.session, dialect_name, text, columns, limit, config['SEARCH_MIN_SUBSTRING'])
+        return [dict(zip(keys, row)) for row in rows]
+    names = cache.get_or_compute('search.names', None, ('students',), load_names)
+    student_ids = names.search(text, limit, config['SEARCH_MIN_SUBSTRING'])
+    rows = {row.id: row for row in db.session.execute(select(*columns).where(StudentModel.id.in_(student_ids)))}
+    return [dict(zip(keys, rows[student_id])) for student_id in student_ids if student_id in rows]
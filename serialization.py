@@ -0,0 +1,53 @@
+import json
+
+from flask import current_app, make_response
+from sqlalchemy import func
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def field_columns(fields_spec, **columns):
+    """Labeled columns giving rows in the order and with the values marshal(row, fields_spec) would output.
+    Defaults of the fields, like 0 for an Integer, are applied by the database"""
+    labeled = []
+    for name, field in fields_spec.items():
+        column = columns[name]
+        default = (field() if isinstance(field, type) else field).default
+        if default is not None:
+            column = func.coalesce(column, default)
+        labeled.append(column.label(name))
+    return labeled
+
+
+def rows_to_dicts(rows):
+    """Dictionaries of rows of a select() of field_columns()"""
+    if not rows:
+        return []
+    keys = rows[0]._fields
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def row_to_dict(row):
+    return None if row is None else dict(zip(row._fields, row))
+
+
+def dumps(data, config, debug=False):
+    """Encode data as Flask-RESTful does, or with orjson when API_JSON_ENCODER is 'orjson'.
+    orjson writes compact UTF-8 JSON, the default encoder keeps the responses byte-for-byte the same"""
+    if config.get('API_JSON_ENCODER') == 'orjson' and orjson is not None:
+        option = orjson.OPT_APPEND_NEWLINE | (orjson.OPT_INDENT_2 if debug else 0)
+        return orjson.dumps(data, option=option)
+    settings = dict(config.get('RESTFUL_JSON', {}))
+    if debug:
+        settings.setdefault('indent', 4)
+    return (json.dumps(data, **settings) + '\n').encode()
+
+
+def output_json(data, code, headers=None):
+    """JSON representation of the v1 API resources"""
+    response = make_response(dumps(data, current_app.config, current_app.debug), code)
+    response.headers.extend(headers or {})
+    return response
@@ -0,0 +1,153 @@
+from flask import Blueprint, render_template, request, url_for
+from flask_menu import register_menu
+from sqlalchemy import and_, true
+from werkzeug.utils import redirect
+
+from admission import admission
+from cache import cache
+from coalescing import enrollment_writer
+from conditional import cacheable
+from models import db, GroupModel, StudentModel, CourseModel, attending
+from pagination import page_args, keyset_page
+from replica import read_only
+from roster import roster
+
+web_bp = Blueprint('web', __name__)
+admission.register(web_bp)
+
+
+@web_bp.route('/')
+@register_menu(web_bp, '.home', 'Home')
+@cacheable
+def index():
+    return render_template('index.html', title='Home')
+
+
+@web_bp.route('/groups/')
+@register_menu(web_bp, '.groups', 'Groups')
+@cacheable
+@read_only
+def groups():
+    max_amount = request.args.get('max', type=int, default=30)
+    group_list = cache.get_or_compute('web.groups', max_amount, ('groups', 'students'),
+                                      lambda: (db.session
+                                               .query(GroupModel.name, GroupModel.students_count.label('amount'))
+                                               .filter(GroupModel.students_count > 0,
+                                                       GroupModel.students_count <= max_amount)
+                                               .order_by(GroupModel.id)
+                                               .all()))
+    return render_template('groups.html', title='Groups', group_list=group_list, max_amount=max_amount)
+
+
+@web_bp.route('/students/')
+@register_menu(web_bp, '.students', 'Students')
+@cacheable
+@read_only
+def students():
+    after_id, limit = page_args()
+    students_query = db.session.query(StudentModel.id, StudentModel.first_name, StudentModel.last_name)
+    students_list, next_id = keyset_page(students_query, StudentModel.id, after_id, limit)
+    return render_template('students.html', title='Students', students_list=students_list, after_id=after_id,
+                           next_id=next_id, limit=limit)
+
+
+@web_bp.route('/students/<int:student_id>')
+@cacheable
+@read_only
+def show_student(student_id):
+    # One row per course with the student and group repeated, or a single row without a course when there are none
+    rows = (db.session
+            .query(StudentModel.first_name, StudentModel.last_name, GroupModel.name.label('group_name'),
+                   CourseModel.id.label('course_id'), CourseModel.course_name,
+                   attending.c.student_id.isnot(None).label('enrolled'))
+            .outerjoin(GroupModel, StudentModel.group_id == GroupModel.id)
+            .outerjoin(CourseModel, true())
+            .outerjoin(attending, and_(attending.c.course_id == CourseModel.id,
+                                       attending.c.student_id == StudentModel.id))
+            .filter(StudentModel.id == student_id)
+            .order_by(CourseModel.id)
+            .all())
+    courses = [row for row in rows if row.course_id is not None]
+    return render_template('show_student.html', title='Student', student=rows[0] if rows else None,
+                           student_id=student_id, attended_courses=[row for row in courses if row.enrolled],
+                           available_courses=[row for row in courses if not row.enrolled])
+
+
+@web_bp.route('/students/add', methods=['GET', 'POST'])
+def add_student():
+    group_list = db.session.query(GroupModel.id, GroupModel.name).order_by(GroupModel.id)
+    new_student = ''
+    if request.method == 'POST':
+        group_id = request.form['group'] if request.form['group'] else None
+        new_student = StudentModel(group_id, request.form['first_name'], request.form['last_name'])
+    if new_student:
+        db.session.add(new_student)
+        db.session.flush()
+        cache.mark_changed('students')
+        roster.students_added([(new_student.id, new_student.group_id)])
+        db.session.commit()
+        return redirect(url_for('web.students'))
+    else:
+        return render_template('add_student.html', title='Add student', group_list=group_list)
+
+
+@web_bp.route('/students/delete_student')
+def delete_student():
+    student_id = request.args.get('student_id', type=int)
+    if student_id:
+        student = db.session.query(StudentModel).get(student_id)
+        db.session.delete(student)
+        cache.mark_changed('students', 'attending')
+        roster.students_deleted([student_id])
+        db.session.commit()
+    return redirect(url_for('web.students'))
+
+
+@web_bp.route('/courses/')
+@register_menu(web_bp, '.courses', 'Courses')
+@cacheable
+@read_only
+def courses():
+    course_name = request.args.get('course_name', type=str, default='')
+    students_list = []
+    course_list = cache.get_or_compute('web.courses', None, ('courses', 'attending'),
+                                       lambda: (db.session
+                                                .query(CourseModel.course_name,
+                                                       CourseModel.enrolled_count.label('amount'))
+                                                .filter(CourseModel.enrolled_count > 0)
+                                                .order_by(CourseModel.course_name)
+                                                .all()))
+    if course_name:
+        students_list = (db.session
+                         .query(StudentModel.first_name, StudentModel.last_name, attending.c.course_id)
+                         .join(attending)
+                         .join(CourseModel)
+                         .where(CourseModel.course_name == course_name)
+                         )
+    return render_template('courses.html', title='Groups', course_list=course_list, course_name=course_name,
+                           students_list=students_list)
+
+
+@web_bp.route('/students/delete_course')
+def delete_course():
+    student_id = request.args.get('student_id', type=int)
+    course_id = request.args.get('course_id', type=int)
+    if course_id:
+        enrollment_writer.remove(student_id, course_id)
+    return redirect(f'/students/{student_id}')
+
+
+@web_bp.route('/students/add_course', methods=['GET', 'POST'])
+def add_course():
+    course_id = ''
+    if request.method == 'POST':
+        course_id = request.form['course']
+    student_id = request.args.get('student_id', type=int)
+    if course_id:
+        enrollment_writer.add(student_id, int(course_id))
+    return redirect(f'/students/{student_id}')
+
+
+@web_bp.app_errorhandler(404)
+def page_not_found(error):
+    return render_template('page404.html', title='Page not found')